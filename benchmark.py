@@ -0,0 +1,476 @@
+# MesoDB Benchmarks
+
+# Libraries
+#
+import datetime
+import json
+import logging
+import os
+import os.path as osp
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from contextlib import contextmanager
+from functools import partial
+import numpy as np
+import pandas as pd
+try:
+    from .utils import *
+    from .storage import *
+    from .mesoDB import mesoDB
+except:
+    from utils import *
+    from storage import *
+    from mesoDB import mesoDB
+
+# States of the synthetic stations, laid out as a grid of cells over the contiguous United States
+STATES = ['WA','MT','ND','MN','WI','MI','NY','ME',
+          'OR','ID','SD','IA','IL','OH','PA','VT',
+          'NV','WY','NE','MO','IN','WV','NJ','MA',
+          'CA','UT','CO','KS','KY','VA','MD','CT',
+          'AZ','NM','OK','AR','TN','NC','DE','RI',
+          'TX','LA','MS','AL','GA','SC','FL','NH']
+GRID = (6, 8)
+BOUNDS = (25., 49., -125., -67.)
+
+# Return bounding box of the cell of a synthetic state
+#
+# @ Param state - state code
+#
+def state_bounds(state):
+    k = STATES.index(state.upper())
+    row,col = divmod(k, GRID[1])
+    lat1,lat2,lon1,lon2 = BOUNDS
+    dlat,dlon = (lat2-lat1)/GRID[0],(lon2-lon1)/GRID[1]
+    return lat2-(row+1)*dlat,lat2-row*dlat,lon1+col*dlon,lon1+(col+1)*dlon
+
+# Fake MesoWest client returning synthetic timeseries responses with the interface of MesoPy.Meso. The stations
+# and observations are deterministic, so every client created with the same parameters returns the same responses.
+#
+class syntheticMeso(object):
+
+    # Synthetic MesoWest client constructor
+    #
+    # @ Param token - MesoWest token, not used
+    # @ Param stations - number of stations
+    # @ Param cadence - minutes between observations of a station
+    # @ Param missing - fraction of missing values
+    # @ Param scale - stations spread over the country (country) or inside a single state (state)
+    # @ Param latency - seconds added to each response to simulate the network
+    # @ Param seed - seed of the random station catalog
+    #
+    def __init__(self, token=None, stations=2000, cadence=10, missing=.05, scale='country', latency=0., seed=0):
+        self.cadence = cadence
+        self.missing = missing
+        self.latency = latency
+        self.seed = seed
+        rnd = np.random.RandomState(seed)
+        if scale == 'state':
+            states = np.array(['CA']*stations)
+        else:
+            states = np.array(STATES)[rnd.randint(0, len(STATES), stations)]
+        bounds = np.array([state_bounds(state) for state in STATES])[pd.Index(STATES).get_indexer(states)]
+        self.stations = pd.DataFrame({'STID': ['SYN{:05d}'.format(k) for k in range(stations)],
+                                      'LATITUDE': rnd.uniform(bounds[:,0], bounds[:,1]),
+                                      'LONGITUDE': rnd.uniform(bounds[:,2], bounds[:,3]),
+                                      'ELEVATION': rnd.uniform(0, 3000, stations).round(),
+                                      'STATE': states,
+                                      # minute of the first observation of each hour
+                                      'PHASE': rnd.randint(0, cadence, stations)})
+
+    # Return stations of a request
+    #
+    # @ Param params - parameters of the request
+    #
+    def select(self, params):
+        stations = self.stations
+        if params.get('state') is not None:
+            stations = stations[stations['STATE'] == params['state'].upper()]
+        elif params.get('bbox') is not None:
+            bbox = params['bbox']
+            lon1,lat1,lon2,lat2 = map(float, bbox.split(',') if isinstance(bbox, str) else bbox)
+            stations = stations[stations['LATITUDE'].between(lat1, lat2) & stations['LONGITUDE'].between(lon1, lon2)]
+        return stations
+
+    # Return synthetic timeseries of observations like MesoPy.Meso.timeseries
+    #
+    # @ Param start - start time of the request (YYYYmmddHHMM)
+    # @ Param end - end time of the request (YYYYmmddHHMM)
+    # @ Param vars - comma separated MesoWest variables
+    # @ Param params - other parameters of the request (country, state or bbox)
+    #
+    def timeseries(self, start, end, vars='fuel_moisture', **params):
+        start = np.datetime64(datetime.datetime.strptime(start, '%Y%m%d%H%M'), 'm')
+        end = np.datetime64(datetime.datetime.strptime(end, '%Y%m%d%H%M'), 'm')
+        rnd = np.random.RandomState(zlib.crc32('{} {} {}'.format(start, end, self.seed).encode()))
+        minutes = np.arange(start.astype(np.int64), end.astype(np.int64)+1)
+        stations = []
+        for st in self.select(params).itertuples():
+            times = minutes[minutes % self.cadence == st.PHASE].astype('datetime64[m]')
+            if not len(times):
+                continue
+            obs = {'date_time': list(np.datetime_as_string(times, unit='s', timezone='UTC'))}
+            for var in vars.split(','):
+                values = rnd.uniform(1, 30, len(times)).round(2).astype(object)
+                values[rnd.uniform(size=len(times)) < self.missing] = None
+                obs['{}_set_1'.format(var)] = values.tolist()
+            stations.append({'STID': st.STID, 'LATITUDE': str(st.LATITUDE), 'LONGITUDE': str(st.LONGITUDE),
+                             'ELEVATION': str(st.ELEVATION), 'STATE': st.STATE, 'OBSERVATIONS': obs})
+        if self.latency:
+            time.sleep(self.latency)
+        return {'SUMMARY': {'RESPONSE_CODE': 1 if len(stations) else 2, 'NUMBER_OF_OBJECTS': len(stations)},
+                'STATION': stations}
+
+# Return count, mean and percentiles in milliseconds of a list of latencies in seconds
+#
+# @ Param latencies - list of latencies in seconds
+#
+def percentiles(latencies):
+    if not len(latencies):
+        return {'count': 0}
+    ms = np.asarray(latencies)*1000.
+    return {'count': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)), 'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+# Replace a method of an object by a wrapper recording its latencies and, optionally, its first argument
+#
+# @ Param obj - object with the method
+# @ Param name - name of the method
+# @ Param latencies - list where to append the latencies
+# @ Param args - set where to add the first argument of the calls, None does not record it
+#
+def instrument(obj, name, latencies, args=None):
+    method = getattr(obj, name)
+    def wrapper(*a, **kw):
+        if args is not None and len(a):
+            args.add(a[0])
+        t0 = time.perf_counter()
+        try:
+            return method(*a, **kw)
+        finally:
+            latencies.append(time.perf_counter() - t0)
+    setattr(obj, name, wrapper)
+
+# Return modification stamps of the files of a folder
+#
+# @ Param folder_path - path of the folder
+#
+def file_stamps(folder_path):
+    stamps = {}
+    for root,_,files in os.walk(folder_path):
+        for name in files:
+            st = os.stat(osp.join(root, name))
+            stamps[osp.join(root, name)] = (st.st_mtime_ns, st.st_size)
+    return stamps
+
+# Context manager measuring wall time and, optionally, peak memory traced by tracemalloc into a result dictionary
+#
+# @ Param result - dictionary where to save seconds and peak_memory_mb
+# @ Param memory - trace peak memory, slows down the code measured
+#
+@contextmanager
+def measure(result, memory=True):
+    if memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        result['seconds'] = time.perf_counter() - t0
+        if memory:
+            result['peak_memory_mb'] = tracemalloc.get_traced_memory()[1]/1024.**2
+            tracemalloc.stop()
+
+# Create a synthetic dataframe of observations like the ones returned by meso_data_2_df
+#
+# @ Param stations - number of stations
+# @ Param hours - number of hours
+# @ Param cadence - minutes between observations of a station
+# @ Param start_utc - start datetime at UTC
+#
+def synthetic_frame(stations=2000, hours=24, cadence=10, start_utc=datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)):
+    times = pd.date_range(start_utc, periods=hours*60//cadence, freq='{}min'.format(cadence))
+    stids = np.array(['ST{:05d}'.format(k) for k in range(stations)], dtype=object)
+    return pd.DataFrame({'STID': np.repeat(stids, len(times)),
+                         'datetime': np.tile(times, stations),
+                         'fm10': np.random.uniform(1, 30, stations*len(times))})
+
+# Legacy hour bucketing of save_to_DB, formatting every row once per hour
+#
+# @ Param data - dataframe with observations
+# @ Param start_utc - start datetime at UTC
+# @ Param end_utc - end datetime at UTC
+#
+def legacy_hour_groups(data, start_utc, end_utc):
+    groups = {}
+    while start_utc < end_utc:
+        groups[start_utc] = data[data['datetime'].apply(meso_time) == meso_time(start_utc)]
+        start_utc += datetime.timedelta(hours=1)
+    return groups
+
+# Benchmark the hour bucketing of save_to_DB, returns rows per second before and after
+#
+# @ Param stations - number of stations
+# @ Param hours - number of hours
+# @ Param cadence - minutes between observations of a station
+#
+def bench_hour_groups(stations=2000, hours=24, cadence=10):
+    start_utc = datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)
+    data = synthetic_frame(stations, hours, cadence, start_utc)
+    end_utc = start_utc + datetime.timedelta(hours=hours)
+    t0 = time.perf_counter()
+    legacy = legacy_hour_groups(data, start_utc, end_utc)
+    t1 = time.perf_counter()
+    groups = hour_groups(data)
+    t2 = time.perf_counter()
+    assert sum([len(g) for g in legacy.values()]) == sum([len(g) for g in groups.values()])
+    return {'rows': len(data), 'legacy_rows_sec': len(data)/(t1-t0), 'vectorized_rows_sec': len(data)/(t2-t1)}
+
+# Benchmark the trim of the boundary hours of a query by time_slice, comparing the mask and the binary search of the
+# station groups for hour files with different numbers of observations per station. Returns the method chosen by
+# slice_method and the milliseconds of both for each of them.
+#
+# @ Param stations - number of stations
+# @ Param per_hour - list of numbers of observations per station in an hour
+# @ Param repeat - number of times each method is run
+#
+def bench_time_slice(stations=2000, per_hour=(1, 6, 12, 60, 360), repeat=20):
+    results = []
+    for count in per_hour:
+        hour = 3600*10**9
+        times = np.tile(np.arange(count, dtype=np.int64)*(hour//count), stations)
+        starts = group_starts(np.repeat(np.arange(stations), count))
+        # query starting in the middle of the hour
+        t0,t1 = hour//2,hour
+        result = {'per_hour': count, 'rows': len(times), 'method': slice_method(len(times), starts)}
+        for method in ('mask','search'):
+            t = time.perf_counter()
+            for _ in range(repeat):
+                rows = time_slice(times, starts, t0, t1, method)
+            result[method + '_ms'] = (time.perf_counter() - t)/repeat*1000.
+            result[method + '_rows'] = len(times) if rows is None else len(rows)
+        assert result['mask_rows'] == result['search_rows']
+        results.append(result)
+    return results
+
+# Benchmark the parsing of synthetic MesoWest responses by meso_data_2_df
+#
+# @ Param client - synthetic MesoWest client
+# @ Param hours - number of hours of each response
+# @ Param repeat - number of responses parsed
+# @ Param memory - trace peak memory
+#
+def bench_parse(client, hours=24, repeat=3, memory=True):
+    start_utc = datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)
+    end_utc = start_utc + datetime.timedelta(hours=hours)
+    response = client.timeseries(start=meso_time(start_utc), end=meso_time(end_utc))
+    latencies = []
+    result = {}
+    with measure(result, memory):
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            data,sites = meso_data_2_df(response)
+            latencies.append(time.perf_counter() - t0)
+    result.update({'rows': len(data), 'stations': len(sites), 'rows_sec': repeat*len(data)/result['seconds'],
+                   'latency': percentiles(latencies)})
+    return result
+
+# Benchmark an update of a new database from a synthetic MesoWest client
+#
+# @ Param folder_path - path of the new database
+# @ Param factory - function creating the synthetic MesoWest clients from a token
+# @ Param storage - storage engine name
+# @ Param hours - number of hours updated
+# @ Param state - state of the update, None updates the whole country
+# @ Param memory - trace peak memory
+#
+def bench_ingest(folder_path, factory, storage='pickle', hours=24, state=None, memory=True):
+    start_utc = datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)
+    db = mesoDB(folder_path, 'benchmark', storage=storage, mesoFactory=factory)
+    db.update['startTime'] = start_utc
+    db.update['endTime'] = start_utc + datetime.timedelta(hours=hours)
+    db.update['country'] = None if state else 'us'
+    db.update['state'] = state
+    fetches,saves = [],[]
+    instrument(db, 'try_meso', fetches)
+    instrument(db, 'save_to_DB', saves)
+    before = file_stamps(folder_path)
+    result = {'storage': storage}
+    with measure(result, memory):
+        db.update_DB()
+    after = file_stamps(folder_path)
+    rows = sum([len(db.storage.read(path, columns=['STID','datetime'])) for path in db.storage.list_hours(folder_path)])
+    result.update({'rows': rows, 'rows_sec': rows/result['seconds'], 'requests': len(fetches),
+                   'files_written': len([path for path,stamp in after.items() if before.get(path) != stamp]),
+                   'fetch_latency': percentiles(fetches), 'save_latency': percentiles(saves)})
+    return result
+
+# Benchmark queries of random time windows and states of a database
+#
+# @ Param folder_path - path of the database
+# @ Param factory - function creating the synthetic MesoWest clients from a token
+# @ Param hours - number of hours in the database
+# @ Param queries - number of queries
+# @ Param window - maximum length of the time windows in hours
+# @ Param states - states queried, None queries the whole database
+# @ Param memory - trace peak memory
+# @ Param seed - seed of the random queries
+#
+def bench_query(folder_path, factory, hours=24, queries=20, window=6, states=None, memory=True, seed=0):
+    start_utc = datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)
+    db = mesoDB(folder_path, mesoFactory=factory)
+    db.params['updateDB'] = False
+    db.cache.clear()
+    latencies = []
+    paths = set()
+    for name in ('read', 'read_arrays'):
+        if hasattr(db.storage, name):
+            instrument(db.storage, name, [], paths)
+    rnd = np.random.RandomState(seed)
+    rows = 0
+    result = {'storage': db.storage.name}
+    with measure(result, memory):
+        for _ in range(queries):
+            start = start_utc + datetime.timedelta(minutes=int(rnd.randint(0, max(hours-window, 1)*60)))
+            db.params['startTime'] = start
+            db.params['endTime'] = start + datetime.timedelta(minutes=int(rnd.randint(60, window*60+1)))
+            db.params['state'] = None if not states else states[rnd.randint(len(states))]
+            t0 = time.perf_counter()
+            rows += len(db.get_DB())
+            latencies.append(time.perf_counter() - t0)
+    result.update({'queries': queries, 'rows': rows, 'rows_sec': rows/result['seconds'], 'files_read': len(paths),
+                   'latency': percentiles(latencies), 'cache': db.cache.stats()})
+    return result
+
+# Benchmark a batch of state queries over the same time window against running them one at a time
+#
+# @ Param folder_path - path of a database with synthetic data
+# @ Param factory - function creating the synthetic client from a token
+# @ Param hours - number of hours of data in the database
+# @ Param states - list of state codes, one query per state
+# @ Param memory - trace peak memory of the queries
+#
+def bench_batch(folder_path, factory, hours=24, states=('CA','NV','OR','AZ','UT','ID'), memory=True):
+    start_utc = datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)
+    db = mesoDB(folder_path, mesoFactory=factory)
+    db.params['updateDB'] = False
+    queries = [{'startTime': start_utc, 'endTime': start_utc + datetime.timedelta(hours=hours), 'state': state} for state in states]
+    result = {'storage': db.storage.name, 'queries': len(queries)}
+    for name in ('batch','single'):
+        db.cache.clear()
+        # every read of an hour file is counted
+        reads = []
+        for method in ('read', 'read_arrays'):
+            if hasattr(db.storage, method):
+                instrument(db.storage, method, reads)
+        result[name] = {}
+        with measure(result[name], memory):
+            if name == 'batch':
+                rows = sum([len(data) for data in db.get_DB_batch(queries)])
+            else:
+                rows = 0
+                for query in queries:
+                    db.params.update(query)
+                    rows += len(db.get_DB())
+        result[name].update({'rows': rows, 'files_read': len(reads)})
+        # remove the instrumentation of the storage methods
+        db.storage.__dict__.pop('read', None)
+        db.storage.__dict__.pop('read_arrays', None)
+    result['speedup'] = result['single']['seconds']/result['batch']['seconds']
+    return result
+
+# Benchmark the interpolation of the whole time interval to a regular grid, the first call computes the weights and
+# the next ones reuse them
+#
+# @ Param folder_path - path of a database with synthetic data
+# @ Param factory - function creating the synthetic client from a token
+# @ Param hours - number of hours of data in the database
+# @ Param bounds - bounding box of the grid (lat1, lat2, lon1, lon2)
+# @ Param shape - number of grid points in latitude and longitude
+# @ Param repeat - number of calls after the first one
+# @ Param memory - trace peak memory of the calls
+#
+def bench_grid(folder_path, factory, hours=24, bounds=BOUNDS, shape=(100,120), repeat=5, memory=True):
+    start_utc = datetime.datetime(2021,6,1,tzinfo=datetime.timezone.utc)
+    db = mesoDB(folder_path, mesoFactory=factory)
+    db.params['updateDB'] = False
+    db.params['startTime'] = start_utc
+    db.params['endTime'] = start_utc + datetime.timedelta(hours=hours) - datetime.timedelta(seconds=1)
+    lats,lons = np.linspace(bounds[0], bounds[1], shape[0]),np.linspace(bounds[2], bounds[3], shape[1])
+    latencies = []
+    result = {'storage': db.storage.name, 'grid': list(shape)}
+    with measure(result, memory):
+        for _ in range(repeat+1):
+            t0 = time.perf_counter()
+            times,grid = db.get_grid(lats, lons)
+            latencies.append(time.perf_counter() - t0)
+    result.update({'periods': len(times), 'first': latencies[0], 'latency': percentiles(latencies[1:]),
+                   'points_sec': grid.size*repeat/sum(latencies[1:]), 'weights': db.grid_weights.stats()})
+    return result
+
+# Run the ingest, query and grid benchmarks of each storage engine on synthetic data, returns a report dictionary
+#
+# @ Param stations - number of stations
+# @ Param hours - number of hours
+# @ Param cadence - minutes between observations of a station
+# @ Param missing - fraction of missing values
+# @ Param scale - stations spread over the country (country) or inside a single state (state)
+# @ Param storages - list of storage engine names
+# @ Param queries - number of queries of each query benchmark
+# @ Param memory - trace peak memory, slows down the benchmarks
+# @ Param folder_path - folder where to create the databases, None uses a temporary folder
+#
+def run_suite(stations=2000, hours=24, cadence=10, missing=.05, scale='country', storages=('pickle','parquet','mmap'),
+              queries=20, memory=True, folder_path=None):
+    factory = partial(syntheticMeso, stations=stations, cadence=cadence, missing=missing, scale=scale)
+    client = factory()
+    state = 'CA' if scale == 'state' else None
+    report = {'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+              'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+              'params': {'stations': stations, 'hours': hours, 'cadence': cadence, 'missing': missing, 'scale': scale,
+                         'queries': queries, 'memory': memory},
+              'hour_groups': bench_hour_groups(stations, hours, cadence),
+              'time_slice': bench_time_slice(stations, sorted(set([max(1, 60//cadence), 1, 12, 60, 360]))),
+              'parse': bench_parse(client, hours, memory=memory)}
+    root = folder_path or tempfile.mkdtemp(prefix='mesoDB_benchmark_')
+    try:
+        for storage in storages:
+            logging.info('run_suite - benchmarking {} storage'.format(storage))
+            path = osp.join(root, storage)
+            shutil.rmtree(path, ignore_errors=True)
+            report['ingest_' + storage] = bench_ingest(path, factory, storage, hours, state, memory)
+            report['query_all_' + storage] = bench_query(path, factory, hours, queries, memory=memory)
+            report['query_state_' + storage] = bench_query(path, factory, hours, queries,
+                                                           states=['CA'] if state else ['CA','NV','OR','AZ'], memory=memory)
+            report['batch_' + storage] = bench_batch(path, factory, hours, ['CA'] if state else ['CA','NV','OR','AZ','UT','ID'], memory)
+            report['grid_' + storage] = bench_grid(path, factory, hours, state_bounds(state) if state else BOUNDS, memory=memory)
+    finally:
+        if folder_path is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return report
+
+# Runs if this is the file being used
+#
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        # python benchmark.py suite [stations] [hours] [scale] [report_path]
+        report = run_suite(stations=int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+                           hours=int(sys.argv[3]) if len(sys.argv) > 3 else 24,
+                           scale=sys.argv[4] if len(sys.argv) > 4 else 'country')
+        text = json.dumps(report, indent=1, default=str)
+        if len(sys.argv) > 5:
+            with open(sys.argv[5], 'w') as f:
+                f.write(text)
+        else:
+            print(text)
+    else:
+        stations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+        result = bench_hour_groups(stations=stations)
+        logging.info('hour bucketing of {} rows: legacy {:.0f} rows/sec, vectorized {:.0f} rows/sec ({:.1f}x)'.format(
+                     result['rows'], result['legacy_rows_sec'], result['vectorized_rows_sec'],
+                     result['vectorized_rows_sec']/result['legacy_rows_sec']))
@@ -0,0 +1,131 @@
+# MesoDB Hour Frames Cache
+
+# Libraries
+#
+import os
+import threading
+from collections import OrderedDict
+
+# LRU cache of decoded hour frames bounded by a memory budget
+#
+class frameCache(object):
+
+    # Frame cache constructor
+    #
+    # @ Param max_bytes - memory budget of the cache in bytes, 0 disables the cache
+    # @ Param stamp - function returning a stamp of the data of an hour file that changes when the data changes,
+    #                 None if the hour does not exist. None uses the modification time and size of the file.
+    #
+    def __init__(self, max_bytes=512*1024**2, stamp=None):
+        self.max_bytes = max_bytes
+        self.stamp_function = stamp
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Return stamp of the data of an hour file, None if it does not exist
+    #
+    # @ Param path - path of the hour file
+    #
+    def stamp(self, path):
+        if self.stamp_function is not None:
+            return self.stamp_function(path)
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Return cached frame of a file, None if not cached, the file changed or it does not exist
+    #
+    # @ Param path - path of the hour file
+    # @ Param selector - hashable description of the subset of the file, None for the whole file
+    # @ Param stamp - current stamp of the file, None computes it
+    # @ Param count - count the lookup as a hit or a miss, false for the probes of a lookup counted by the caller
+    #
+    def get(self, path, selector=None, stamp=None, count=True):
+        key = (path, selector)
+        stamp = self.stamp(path) if stamp is None else stamp
+        frame = None
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None:
+                if stamp is not None and entry[0] == stamp:
+                    self.frames.move_to_end(key)
+                    frame = entry[2]
+                else:
+                    self.drop(key)
+        if count:
+            self.count(frame is not None)
+        return frame
+
+    # Count a lookup as a hit or a miss
+    #
+    # @ Param hit - the frame was found
+    #
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # Add frame of a file to the cache, evicting the least recently used frames
+    #
+    # @ Param path - path of the hour file
+    # @ Param frame - decoded dataframe
+    # @ Param selector - hashable description of the subset of the file, None for the whole file
+    # @ Param stamp - stamp of the file taken before reading it, None computes it
+    #
+    def put(self, path, frame, selector=None, stamp=None):
+        if self.max_bytes <= 0:
+            return
+        stamp = self.stamp(path) if stamp is None else stamp
+        if stamp is None:
+            return
+        nbytes = int(frame.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        key = (path, selector)
+        with self.lock:
+            if key in self.frames:
+                self.drop(key)
+            self.frames[key] = (stamp, nbytes, frame)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                self.drop(next(iter(self.frames)))
+                self.evictions += 1
+
+    # Remove an entry, the lock has to be held
+    #
+    # @ Param key - key of the entry
+    #
+    def drop(self, key):
+        _,nbytes,_ = self.frames.pop(key)
+        self.bytes -= nbytes
+
+    # Remove all the cached frames of a file
+    #
+    # @ Param path - path of the hour file
+    #
+    def invalidate(self, path):
+        with self.lock:
+            for key in [key for key in self.frames if key[0] == path]:
+                self.drop(key)
+
+    # Remove all the cached frames
+    #
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.bytes = 0
+
+    # Return counters of the cache
+    #
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.frames), 'bytes': self.bytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,231 @@
+# MesoDB Grid Interpolation
+
+# Libraries
+#
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+try:
+    from .spatial import *
+except:
+    from spatial import *
+
+# Grid Interpolation Error
+#
+class interpolationError(Exception):
+    pass
+
+# Interpolation methods, inverse distance weighting of the k nearest stations or value of the nearest station reporting
+METHODS = ('idw','nearest')
+# Maximum number of elements of the temporary arrays of the weights and the evaluation
+CHUNK = 2**22
+
+# Return coordinates of the points of a grid as arrays with the shape of the grid. 1D latitudes and longitudes
+# are the axes of a regular grid, otherwise they are the coordinates of each grid point
+#
+# @ Param lats,lons - latitudes and longitudes in WGS84 degrees
+#
+def grid_coords(lats, lons):
+    lats,lons = np.asarray(lats, dtype=float),np.asarray(lons, dtype=float)
+    if lats.ndim == 1 and lons.ndim == 1:
+        lons,lats = np.meshgrid(lons, lats)
+    if lats.shape != lons.shape:
+        raise interpolationError('grid_coords - latitudes {} and longitudes {} do not have the same shape'.format(lats.shape, lons.shape))
+    return lats,lons
+
+# Return unit vectors of coordinates, the chord distance between them is monotonic with the great circle distance
+#
+# @ Param lats,lons - arrays of coordinates in WGS84 degrees
+#
+def unit_vectors(lats, lons):
+    lats,lons = np.radians(lats),np.radians(lons)
+    return np.stack((np.cos(lats)*np.cos(lons), np.cos(lats)*np.sin(lons), np.sin(lats)), axis=-1)
+
+# Return positions and great circle distances in km of the k nearest points to each target, sorted by distance
+#
+# @ Param points - unit vectors of the points (n x 3)
+# @ Param targets - unit vectors of the targets (m x 3)
+# @ Param k - number of neighbors, at most the number of points
+#
+def nearest_points(points, targets, k):
+    if cKDTree is not None:
+        chord,pos = cKDTree(points).query(targets, k=k)
+        chord,pos = chord.reshape(len(targets), k),pos.reshape(len(targets), k)
+    else:
+        # brute force by chunks of targets, the squared chord distance is 2-2cos
+        logging.debug('nearest_points - scipy not installed, computing all the distances')
+        pos = np.empty((len(targets), k), dtype=np.int64)
+        chord = np.empty((len(targets), k))
+        step = max(1, CHUNK//len(points))
+        for a in range(0, len(targets), step):
+            d2 = np.maximum(2. - 2.*(targets[a:a+step] @ points.T), 0.)
+            near = np.argpartition(d2, k-1, axis=1)[:,:k] if k < len(points) else np.tile(np.arange(k), (len(d2),1))
+            dist = np.take_along_axis(d2, near, axis=1)
+            order = np.argsort(dist, axis=1, kind='stable')
+            pos[a:a+step] = np.take_along_axis(near, order, axis=1)
+            chord[a:a+step] = np.sqrt(np.take_along_axis(dist, order, axis=1))
+    return pos,2.*EARTH_RADIUS*np.arcsin(np.minimum(chord/2., 1.))
+
+# Interpolation weights of the stations at the points of a grid. Each grid point has its k nearest stations and their
+# weights, and the values of all the periods are interpolated at once. Stations without a value in a period are
+# skipped, so the weights are reused while the set of stations does not change.
+#
+class gridWeights(object):
+
+    # Grid weights constructor
+    #
+    # @ Param lats,lons - coordinates of the grid points in WGS84 degrees (arrays with the shape of the grid)
+    # @ Param station_lats,station_lons - arrays of coordinates of the stations in WGS84 degrees
+    # @ Param method - idw (inverse distance weighting) or nearest (nearest station with a value)
+    # @ Param k - number of nearest stations of each grid point
+    # @ Param power - power of the inverse distance weights
+    # @ Param max_distance - stations further than this distance in km are not used, None uses all of them
+    #
+    def __init__(self, lats, lons, station_lats, station_lons, method='idw', k=8, power=2., max_distance=None):
+        if method not in METHODS:
+            raise interpolationError('gridWeights - unknown method {}, available methods are {}'.format(method, list(METHODS)))
+        self.shape = np.shape(lats)
+        self.method = method
+        self.size = int(np.prod(self.shape))
+        self.k = max(0, min(int(k), len(station_lats)))
+        if self.k == 0:
+            self.neighbors = np.zeros((self.size, 0), dtype=np.int32)
+            self.weights = np.zeros((self.size, 0), dtype=np.float32)
+            return
+        pos,dist = nearest_points(unit_vectors(np.asarray(station_lats, dtype=float), np.asarray(station_lons, dtype=float)),
+                                  unit_vectors(np.ravel(lats), np.ravel(lons)), self.k)
+        self.neighbors = pos.astype(np.int32)
+        # grid points on a station take its value
+        weights = 1./np.maximum(dist, 1e-6)**power if method == 'idw' else np.ones_like(dist)
+        if max_distance is not None:
+            weights[dist > max_distance] = 0.
+        self.weights = weights.astype(np.float32)
+
+    # Return memory used by the weights in bytes
+    #
+    def nbytes(self):
+        return self.neighbors.nbytes + self.weights.nbytes
+
+    # Interpolate the values of the stations of all the periods at once, NaN where no station is available
+    #
+    # @ Param values - array of values of the stations by period (periods x stations), NaN if missing
+    #
+    def apply(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        result = np.full((len(values), self.size), np.nan, dtype=np.float32)
+        if not self.k or not len(values):
+            return result.reshape((len(values),) + self.shape)
+        # chunks of grid points so the values gathered (periods x points x k) are bounded
+        step = max(1, CHUNK//(len(values)*self.k))
+        for a in range(0, self.size, step):
+            gathered = values[:, self.neighbors[a:a+step]]
+            weights = self.weights[a:a+step]
+            valid = np.isfinite(gathered) & (weights > 0)
+            if self.method == 'nearest':
+                # neighbors are sorted by distance, first one with a value
+                first = valid.argmax(axis=2)[...,None]
+                nearest = np.take_along_axis(gathered, first, axis=2)[...,0]
+                result[:, a:a+step] = np.where(valid.any(axis=2), nearest, np.nan)
+            else:
+                weights = np.where(valid, weights, np.float32(0))
+                total = weights.sum(axis=2)
+                weighted = (weights*np.where(valid, gathered, np.float32(0))).sum(axis=2)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result[:, a:a+step] = np.where(total > 0, weighted/total, np.nan)
+        return result.reshape((len(values),) + self.shape)
+
+# Return digest of arrays, used as cache key of the grids and station sets
+#
+# @ Param arrays - list of arrays
+#
+def arrays_digest(arrays):
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+# LRU cache of grid weights by grid, station set and interpolation options
+#
+class weightsCache(object):
+
+    # Weights cache constructor
+    #
+    # @ Param max_entries - number of grid weights kept, 0 disables the cache
+    #
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Return grid weights of a grid and a set of stations, computing them if they are not cached
+    #
+    # @ Param lats,lons - coordinates of the grid points in WGS84 degrees (arrays with the shape of the grid)
+    # @ Param ids - array of the IDs of the stations
+    # @ Param station_lats,station_lons - arrays of coordinates of the stations in WGS84 degrees
+    # @ Param options - dictionary of gridWeights options (method, k, power, max_distance)
+    #
+    def get(self, lats, lons, ids, station_lats, station_lons, **options):
+        key = (arrays_digest([lats, lons]), arrays_digest([ids, station_lats, station_lons]), tuple(sorted(options.items())))
+        with self.lock:
+            weights = self.entries.get(key)
+            if weights is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return weights
+            self.misses += 1
+        logging.debug('weightsCache.get - computing weights of {} grid points and {} stations'.format(np.size(lats), len(ids)))
+        weights = gridWeights(lats, lons, station_lats, station_lons, **options)
+        if self.max_entries > 0:
+            with self.lock:
+                self.entries[key] = weights
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return weights
+
+    # Forget all the grid weights
+    #
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Return cache counters
+    #
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                    'bytes': sum([weights.nbytes() for weights in self.entries.values()])}
+
+# Return mean values of the stations in each period of a time interval, from observations with station IDs
+#
+# @ Param ids - array of station IDs of the observations
+# @ Param times - array of epoch nanoseconds of the observations
+# @ Param values - array of values of the observations
+# @ Param periods - DatetimeIndex with the start of each period, evenly spaced
+# @ Param stations - array of station IDs of the columns of the result
+#
+def period_means(ids, times, values, periods, stations):
+    if not len(periods) or not len(stations):
+        return np.full((len(periods), len(stations)), np.nan, dtype=np.float32)
+    start = periods[0].value
+    length = (periods[1] - periods[0]).value if len(periods) > 1 else np.iinfo(np.int64).max
+    period = (np.asarray(times, dtype=np.int64) - start)//length
+    column = pd.Index(stations).get_indexer(ids)
+    keep = (period >= 0) & (period < len(periods)) & (column >= 0) & np.isfinite(values)
+    cells = period[keep]*len(stations) + column[keep]
+    size = len(periods)*len(stations)
+    counts = np.bincount(cells, minlength=size)
+    sums = np.bincount(cells, weights=np.asarray(values, dtype=float)[keep], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums/counts, np.nan)
+    return means.astype(np.float32).reshape(len(periods), len(stations))
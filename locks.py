@@ -0,0 +1,95 @@
+# MesoDB File Locks and Atomic Writes
+
+# Libraries
+#
+import os
+import os.path as osp
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Exclusive lock of a file shared by threads and processes. Uses flock where available, otherwise the lock file
+# is created exclusively and removed on release.
+#
+class fileLock(object):
+
+    # File lock constructor
+    #
+    # @ Param path - path of the lock file
+    # @ Param poll - seconds between attempts when flock is not available
+    #
+    def __init__(self, path, poll=.05):
+        self.path = path
+        self.poll = poll
+        self.fd = None
+
+    # Acquire the lock waiting until it is free
+    #
+    def acquire(self):
+        if not osp.exists(osp.dirname(self.path) or '.'):
+            os.makedirs(osp.dirname(self.path), exist_ok=True)
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+                return
+            except FileExistsError:
+                time.sleep(self.poll)
+
+    # Release the lock
+    #
+    def release(self):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+        else:
+            os.close(self.fd)
+            os.remove(self.path)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+# Return a temporary path next to a file, unique for each process and thread
+#
+# @ Param path - path of the file
+#
+def temp_path(path):
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+# Context manager yielding a temporary path that replaces the file atomically if no exception is raised
+#
+# @ Param path - path of the file
+#
+@contextmanager
+def atomic_write(path):
+    tmp = temp_path(path)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if osp.exists(tmp):
+            os.remove(tmp)
+
+# Return CRC32 checksum of a file
+#
+# @ Param path - path of the file
+#
+def file_checksum(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
@@ -0,0 +1,155 @@
+# MesoDB Coverage Manifest
+
+# Libraries
+#
+import datetime
+import json
+import logging
+import os.path as osp
+try:
+    from .locks import *
+except:
+    from locks import *
+
+# Hour states saved in the manifest
+MISSING = '-'   # hour not in the database
+COMPLETE = 'C'  # hour file complete
+REALTIME = 'T'  # hour file in realtime interval (_tmp file)
+EMPTY = 'E'     # hour known to have no data
+
+# Coverage manifest of the database, one string of 24 hour states per julian day. The hour states set are merged
+# with the ones saved by other processes when the manifest is saved.
+#
+class coverageManifest(object):
+
+    # Coverage manifest constructor
+    #
+    # @ Param folder_path - path of the database
+    # @ Param storage - storage engine of the database
+    #
+    def __init__(self, folder_path, storage):
+        self.folder_path = folder_path
+        self.path = osp.join(folder_path, '.manifest')
+        self.storage = storage
+        self.changes = {}
+        self.load()
+
+    # Return manifest key of a datetime
+    #
+    # @ Param utc_datetime - UTC datetime object
+    #
+    def key(self, utc_datetime):
+        return '{:04d}/{:03d}'.format(utc_datetime.year, utc_datetime.timetuple().tm_yday)
+
+    # Load manifest from disk or build it scanning the database if it does not exist
+    #
+    def load(self):
+        if osp.exists(self.path):
+            self.days = self.read()
+            # hour states not saved yet
+            for (key,hour),state in self.changes.items():
+                hours = self.days.get(key, MISSING*24)
+                self.days[key] = hours[:hour] + state + hours[hour+1:]
+        else:
+            self.scan()
+            self.save()
+
+    # Read manifest saved on disk
+    #
+    def read(self):
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    # Build manifest scanning the hour files of the database
+    #
+    def scan(self):
+        logging.info('coverageManifest.scan - building manifest from {}'.format(self.folder_path))
+        self.days = {}
+        paths = sorted(self.storage.list_hours(self.folder_path), key=lambda path: not path.endswith('_tmp'))
+        # realtime files first, so complete files of the same hour take precedence
+        for path in paths:
+            state = REALTIME if path.endswith('_tmp') else COMPLETE
+            name = osp.basename(path)
+            key = '{}/{}'.format(name[:4], name[4:7])
+            hours = self.days.get(key, MISSING*24)
+            hour = int(name[7:9])
+            self.days[key] = hours[:hour] + state + hours[hour+1:]
+
+    # Save manifest to disk merging the hour states set with the ones saved by other processes
+    #
+    def save(self):
+        with fileLock(self.path + '.lock'):
+            if osp.exists(self.path):
+                days = self.read()
+                for (key,hour),state in self.changes.items():
+                    hours = days.get(key, MISSING*24)
+                    days[key] = hours[:hour] + state + hours[hour+1:]
+                self.days = days
+            self.write()
+        self.changes = {}
+
+    # Write manifest to disk atomically, the lock has to be held
+    #
+    def write(self):
+        with atomic_write(self.path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(self.days, f, sort_keys=True)
+
+    # Forget all the hour states, so all the hours are requested again
+    #
+    def clear(self):
+        with fileLock(self.path + '.lock'):
+            self.days = {}
+            self.changes = {}
+            self.write()
+
+    # Return state of the hour of a datetime
+    #
+    # @ Param utc_datetime - UTC datetime object
+    #
+    def get(self, utc_datetime):
+        return self.days.get(self.key(utc_datetime), MISSING*24)[utc_datetime.hour]
+
+    # Set state of the hour of a datetime
+    #
+    # @ Param utc_datetime - UTC datetime object
+    # @ Param state - new hour state
+    #
+    def set(self, utc_datetime, state):
+        key = self.key(utc_datetime)
+        hours = self.days.get(key, MISSING*24)
+        hour = utc_datetime.hour
+        self.days[key] = hours[:hour] + state + hours[hour+1:]
+        self.changes[(key,hour)] = state
+
+    # Return states of the 24 hours of the day of a datetime
+    #
+    # @ Param utc_datetime - UTC datetime object
+    #
+    def day(self, utc_datetime):
+        return self.days.get(self.key(utc_datetime), MISSING*24)
+
+    # Return the minimal list of contiguous (start, end) intervals with hours to request
+    #
+    # @ Param start_utc - start datetime at UTC
+    # @ Param end_utc - end datetime at UTC
+    # @ Param max_span - maximum length of an interval in hours
+    #
+    def gaps(self, start_utc, end_utc, max_span=24):
+        gaps = []
+        hour = start_utc.replace(minute=0, second=0, microsecond=0)
+        gap_start = None
+        while hour < end_utc:
+            if self.get(hour) in (COMPLETE, EMPTY):
+                if gap_start is not None:
+                    gaps.append((gap_start, hour))
+                    gap_start = None
+            elif gap_start is None:
+                gap_start = hour
+            elif (hour - gap_start).total_seconds()/3600. >= max_span:
+                gaps.append((gap_start, hour))
+                gap_start = hour
+            hour += datetime.timedelta(hours=1)
+        if gap_start is not None:
+            gaps.append((gap_start, end_utc))
+        return gaps
@@ -5,20 +5,46 @@
 #
 import datetime
 import logging
-from MesoPy import Meso
 import numpy as np
 import os.path as osp
 import os
-import sys
 import glob
+import queue
+import sys
+import time
+from collections import deque
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
 try:
     from .utils import *
+    from .storage import *
+    from .manifest import *
+    from .spatial import *
+    from .cache import *
+    from .rollup import *
+    from .tokens import *
+    from .transport import *
+    from .planner import *
+    from .locks import *
+    from .registry import *
+    from .metrics import *
+    from .interpolation import *
 except:
     from utils import *
-
-# increment recursion limit
-sys.setrecursionlimit(10000)
+    from storage import *
+    from manifest import *
+    from spatial import *
+    from cache import *
+    from rollup import *
+    from tokens import *
+    from transport import *
+    from planner import *
+    from locks import *
+    from registry import *
+    from metrics import *
+    from interpolation import *
 
 # Mesowest Database Class Error
 #
@@ -31,13 +57,30 @@ class mesoDB(object):
     
     # mesoDB constructor
     #
-    def __init__(self, folder_path=osp.join(osp.abspath(os.getcwd()),'mesoDB'), mesoToken=[]):
+    # @ Param folder_path - path where to save the database
+    # @ Param mesoToken - token or list of tokens to be used or added to the tokens list
+    # @ Param storage - storage engine name (pickle or parquet), None uses the one of the existent database
+    # @ Param mesoFactory - function creating a MesoWest client from a token, None uses httpTransport
+    #
+    def __init__(self, folder_path=osp.join(osp.abspath(os.getcwd()),'mesoDB'), mesoToken=[], storage=None, mesoFactory=None):
         self.folder_path = folder_path
-        self.stations_path = osp.join(self.folder_path,'stations.pkl')
+        self.index_path = osp.join(self.folder_path,'stations_index.pkl')
+        self.index = None
+        self.cache = frameCache(stamp=self.hour_stamp)
+        self.grid_weights = weightsCache()
         self.exists_here(mesoToken)
-        self.meso = Meso(token=self.tokens[0])
+        self.init_storage(storage)
+        self.registry = stationRegistry(self.folder_path)
+        self.manifest = coverageManifest(self.folder_path, self.storage)
+        self.rollups = rollupStore(self.folder_path)
+        self.add_variables()
+        self.scheduler = tokenScheduler(self.folder_path, self.tokens, mesoFactory or httpTransport)
+        self.meso = self.scheduler.client(self.tokens[0])
+        self.tuner = spanTuner(self.folder_path)
+        self.realtime_hours = set()
+        self.metrics = metrics
         self.init_params()
-        
+
 
     # Add tokens to the mesoDB database
     #
@@ -57,11 +100,36 @@ class mesoDB(object):
             for token in userTokens:  
                 if token not in self.tokens:
                     self.tokens.append(token)
+        if hasattr(self, 'scheduler'):
+            self.scheduler.tokens = self.tokens
         if len(self.tokens) > 0:
             with open(tokens_path,'w') as f:
                 for t in self.tokens:
                     f.write(t+'\n')
 
+    # Add MesoWest variables to the ones saved in the mesoDB database, all of them are fetched in each request
+    #
+    # @ Param variables - string or list of MesoWest variables (for instance, air_temp or relative_humidity)
+    #
+    def add_variables(self, variables=[]):
+        variables_path = osp.join(self.folder_path,'.variables')
+        if osp.exists(variables_path):
+            with open(variables_path,'r') as f:
+                self.variables = [v for v in f.read().split('\n') if v != '']
+        else:
+            self.variables = ['fuel_moisture']
+        if isinstance(variables,str):
+            variables = [variables]
+        new_variables = [v for v in variables if v not in self.variables]
+        if len(new_variables):
+            logging.info('mesoDB.add_variables - adding variables {}'.format(new_variables))
+            self.variables += new_variables
+            # hours already in the database do not have the new variables, fetch them again on the next updates
+            self.manifest.clear()
+        with open(variables_path,'w') as f:
+            for v in self.variables:
+                f.write(v+'\n')
+
     # Checks if mesoDB directory and their tokens exists. If not, it is created
     #
     # @ Param token - token to be used or added to the tokens list
@@ -78,6 +146,34 @@ class mesoDB(object):
         if not len(self.tokens):
             raise mesoDBError('mesoDB.exists_here - no tokens were provided or existent in the database.')
 
+    # Initialize the storage engine of the database
+    #
+    # @ Param storage - storage engine name, None uses the one of the existent database
+    #
+    def init_storage(self, storage):
+        current = read_storage_name(self.folder_path)
+        if current is None:
+            # existent databases without storage file were written in pickle format
+            if len(glob.glob(osp.join(self.folder_path,'[0-9]'*4))):
+                current = 'pickle'
+            else:
+                current = storage or 'pickle'
+            write_storage_name(self.folder_path, current)
+        if storage is not None and storage != current:
+            raise mesoDBError('mesoDB.init_storage - database uses {} storage, migrate it first using mesoDB.migrate_storage.'.format(current))
+        self.storage = get_storage(current)
+
+    # Migrate the database hour files in place to another storage engine
+    #
+    # @ Param storage - storage engine name
+    #
+    def migrate_storage(self, storage):
+        logging.info('mesoDB.migrate_storage - migrating database from {} to {}'.format(self.storage.name, storage))
+        migrate_tree(self.folder_path, storage)
+        self.storage = get_storage(storage)
+        self.manifest.storage = self.storage
+        self.cache.clear()
+
     # Initialize parameters for get_data
     #   
     def init_params(self):
@@ -89,16 +185,33 @@ class mesoDB(object):
                             'latitude1': None, 'latitude2': None, 'longitude1': None, 'longitude2': None}
         self.params = {'startTime': startTime, 'endTime': endTime, 'country': 'us', 'state': None,
                         'latitude1': None, 'latitude2': None, 'longitude1': None, 'longitude2': None, 
-                        'makeFile': False, 'updateDB': True}
+                        'latitude': None, 'longitude': None, 'radius': None, 'nearest': None,
+                        'stations': None, 'variables': None, 'makeFile': False, 'updateDB': True, 'compact': True}
         # general parameters
         self.realtime_length = 120 # length of current data in minutes
+        self.realtime_overlap = 30 # minutes fetched again on each realtime poll for observations arriving late
+        self.workers = 4 # number of concurrent MesoWest requests when updating the database
+        self.token_workers = 2 # maximum number of concurrent MesoWest requests per token
+        self.max_span = None # maximum length of a MesoWest request in hours, None chooses it from the previous requests
+        self.scan_processes = os.cpu_count() or 1 # maximum number of processes reading the hour files of large queries
+        self.scan_hours = 96 # minimum number of hours read by each process, shorter queries are read by a single process
 
     # Get sites processed by the database
     #
     def sites(self):
-        if osp.exists(self.stations_path):
-            return pd.read_pickle(self.stations_path)
-        return pd.DataFrame([])
+        return self.registry.sites()
+
+    # Get spatial index of the sites processed by the database, cached in memory and on disk
+    #
+    def station_index(self):
+        stamp = self.registry.stamp()
+        if self.index is None or self.index.stamp != stamp:
+            self.index = stationIndex.load(self.index_path, stamp)
+            if self.index is None:
+                logging.debug('mesoDB.station_index - building station index')
+                self.index = stationIndex(self.sites())
+                self.index.save(self.index_path, stamp)
+        return self.index
 
     # Set start UTC datetime from integers for the update parameters
     #
@@ -172,7 +285,7 @@ class mesoDB(object):
         path = osp.join(self.folder_path,'{:4d}'.format(year),'{:03d}'.format(jday))
         return path
 
-    # Return path to the hour pickle file
+    # Return path to the hour file
     #
     # @ Param utc_datetime - UTC datetime object
     #
@@ -180,7 +293,7 @@ class mesoDB(object):
         year = utc_datetime.year
         jday = utc_datetime.timetuple().tm_yday
         hour = utc_datetime.hour
-        path = osp.join(self.julian_path(utc_datetime),'{:04d}{:03d}{:02d}.pkl'.format(year, jday, hour))
+        path = osp.join(self.julian_path(utc_datetime),'{:04d}{:03d}{:02d}.{}'.format(year, jday, hour, self.storage.ext))
         return path
         
     # Checks if month folder exists, if not, make it
@@ -195,28 +308,248 @@ class mesoDB(object):
     # @ Param utc_datetime - UTC datetime object
     #
     def day_is_empty(self, utc_datetime):
-        if self.julian_exists(utc_datetime):
-            path = osp.join(self.julian_path(utc_datetime), '*.pkl')
-            return len(glob.glob(path)) == 0
-        return True
+        return all([h == MISSING for h in self.manifest.day(utc_datetime)])
 
     # Checks if day is full, if so returns true, else false
     #
     # @ Param utc_datetime - UTC datetime object
     #
     def day_is_full(self, utc_datetime):
-        if self.julian_exists(utc_datetime):
-            path = osp.join(self.julian_path(utc_datetime), '*.pkl')
-            return len(glob.glob(path)) == 24
-        return False
+        return all([h in (COMPLETE, EMPTY) for h in self.manifest.day(utc_datetime)])
 
     # Checks if hour file exits, if so returns true, else false
     #
     # @ Param utc_datetime - UTC datetime object
     #
     def hour_file_exists(self, utc_datetime):
-        return osp.exists(self.hour_path(utc_datetime))
+        return self.storage.exists(self.hour_path(utc_datetime))
     
+    # Return stamp of the data of an hour file from the storage engine, None if it does not exist
+    #
+    # @ Param path - path of the hour file
+    #
+    def hour_stamp(self, path):
+        return self.storage.stamp(path)
+
+    # Read an hour file using the cache of decoded hour frames
+    #
+    # @ Param path - path of the hour file
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    # @ Param columns - list of columns to read, None reads all of them
+    #
+    def read_hour(self, path, stids=None, columns=None):
+        selector = None
+        if stids is not None or columns is not None:
+            selector = (None if stids is None else tuple(sorted([str(s) for s in stids])),
+                        None if columns is None else tuple(columns))
+        # stamp taken before reading, so a frame read while the file changes is not kept as current
+        stamp = self.cache.stamp(path)
+        data = self.cache.get(path, selector, stamp=stamp, count=False)
+        if data is None and selector is not None:
+            # filter whole hour frame if it is cached, keeping the subset for the next reads
+            data = self.cache.get(path, stamp=stamp, count=False)
+            if data is not None:
+                if stids is not None:
+                    data = data[data['STID'].isin(stids)]
+                if columns is not None:
+                    data = data[[c for c in columns if c in data]]
+                self.cache.put(path, data, selector, stamp=stamp)
+        self.cache.count(data is not None)
+        if data is None:
+            metrics.inc('cache.misses')
+            metrics.inc('files.read')
+            with metrics.timer('stage.read_file'):
+                data = self.storage.read(path, columns=columns, stids=stids)
+            self.cache.put(path, data, selector, stamp=stamp)
+        else:
+            metrics.inc('cache.hits')
+        return data
+
+    # Return hours and paths of the hour files with data in a time interval
+    #
+    # @ Param start_utc - start datetime at UTC
+    # @ Param end_utc - end datetime at UTC
+    #
+    def hour_files(self, start_utc, end_utc):
+        paths = []
+        tmp_start = start_utc.replace(minute=0,second=0,microsecond=0)
+        while tmp_start <= end_utc:
+            path = self.hour_path(tmp_start)
+            if self.storage.exists(path):
+                paths.append((tmp_start, path))
+            elif self.storage.exists(path + '_tmp'):
+                paths.append((tmp_start, path + '_tmp'))
+            else:
+                logging.warning('mesoDB.hour_files - could not find data for time {}'.format(tmp_start))
+            tmp_start = tmp_start + datetime.timedelta(hours=1)
+        return paths
+
+    # Return time interval in epoch nanoseconds to trim an hour file to, None if the whole hour is inside the interval
+    #
+    # @ Param path - path of the hour file
+    # @ Param start_utc - start datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param end_utc - end datetime at UTC
+    #
+    def hour_bounds(self, path, start_utc, end_utc):
+        if start_utc is None:
+            return None
+        hour = pd.Timestamp(datetime.datetime.strptime(osp.basename(path)[:9], '%Y%j%H'), tz='UTC').value
+        t0,t1 = pd.Timestamp(start_utc).value,pd.Timestamp(end_utc).value
+        if t0 <= hour and hour + 3600*10**9 - 1 <= t1:
+            return None
+        return t0,t1
+
+    # Return rows of an hour frame inside a time interval, slicing the station groups of time-sorted hour files
+    # by binary search
+    #
+    # @ Param data - dataframe of the hour
+    # @ Param bounds - time interval in epoch nanoseconds
+    #
+    def trim_hour(self, data, bounds):
+        return trim_observations(data, bounds)
+
+    # Return positions of the rows of memory-mapped hour columns to keep, None keeps all of them
+    #
+    # @ Param path - path of the hour file
+    # @ Param arrays - dictionary of hour column arrays
+    # @ Param codes - station codes to keep, None keeps all of them
+    # @ Param bounds - time interval to keep in epoch nanoseconds, None if the hour is inside the interval
+    #
+    def mapped_rows(self, path, arrays, codes, bounds=None):
+        rows = None
+        if bounds is not None:
+            if self.storage.time_sorted(path):
+                rows = time_slice(arrays['time'], group_starts(arrays['stid']), *bounds)
+            else:
+                rows = np.flatnonzero((arrays['time'] >= bounds[0]) & (arrays['time'] <= bounds[1]))
+        if codes is not None:
+            keep = np.isin(arrays['stid'] if rows is None else arrays['stid'][rows], codes)
+            rows = np.flatnonzero(keep) if rows is None else rows[keep]
+        return rows
+
+    # Read hour files of a zero-copy storage engine allocating the result columns only once, so the
+    # memory used is the size of the result. Observations are kept as views of the files if possible.
+    # The rows of each hour are counted first and copied into the result later, so no views of the files
+    # are kept between hours and only a bounded number of memory maps is open.
+    #
+    # @ Param paths - paths of the hour files
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    # @ Param start_utc - start datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param end_utc - end datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param columns - list of columns to read, None reads all of them
+    #
+    def read_mapped(self, paths, stids, start_utc=None, end_utc=None, columns=None):
+        if not len(paths):
+            return pd.DataFrame([])
+        metrics.inc('files.read', len(paths))
+        day_path = osp.dirname(paths[0])
+        codes = None if stids is None else self.storage.codes(day_path, stids)
+        if len(paths) == 1:
+            arrays = self.storage.read_arrays(paths[0], columns)
+            rows = self.mapped_rows(paths[0], arrays, codes, self.hour_bounds(paths[0], start_utc, end_utc))
+            if rows is None:
+                return arrays_2_df(arrays, self.registry.categories())
+        # find rows to keep, only the hours at the ends of the interval are trimmed
+        selections = []
+        dtypes = {}
+        for path in paths:
+            arrays = self.storage.read_arrays(path, columns)
+            rows = self.mapped_rows(path, arrays, codes, self.hour_bounds(path, start_utc, end_utc))
+            selections.append((path, len(arrays['time']), rows))
+            for column,values in arrays.items():
+                dtypes.setdefault(column, values.dtype)
+        # copy rows to keep into the result columns
+        counts = [length if rows is None else len(rows) for _,length,rows in selections]
+        result = {column: np.empty(sum(counts), dtype=dtype) for column,dtype in dtypes.items()}
+        n = 0
+        for (path,length,rows),count in zip(selections, counts):
+            arrays = self.storage.read_arrays(path, columns)
+            if len(arrays['time']) < length:
+                # the hour was rewritten by another process since it was counted
+                logging.info('mesoDB.read_mapped - {} changed while reading it, reading the hours again'.format(path))
+                return self.read_mapped(paths, stids, start_utc, end_utc, columns)
+            for column,values in result.items():
+                if column not in arrays:
+                    values[n:n+count] = np.nan
+                elif rows is None:
+                    values[n:n+count] = arrays[column][:length]
+                else:
+                    np.take(arrays[column], rows, out=values[n:n+count])
+            n += count
+        return arrays_2_df(result, self.registry.categories())
+
+    # Read hour files into a dataframe in the compact schema, with the station IDs of the registry as codes of STID.
+    # Only the hours at the ends of the time interval are trimmed.
+    #
+    # @ Param paths - paths of the hour files
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    # @ Param start_utc - start datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param end_utc - end datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param columns - list of columns to read, None reads all of them
+    #
+    def read_DB(self, paths, stids, start_utc=None, end_utc=None, columns=None):
+        if stids is not None and not len(stids):
+            return pd.DataFrame([])
+        if getattr(self.storage, 'zero_copy', False):
+            # Copy memory-mapped columns straight into the result
+            return self.read_mapped(paths, stids, start_utc, end_utc, columns)
+        workers = self.scan_workers(paths)
+        if workers > 1:
+            try:
+                return self.scan_DB(paths, stids, start_utc, end_utc, columns, workers)
+            except (OSError, BrokenProcessPool) as e:
+                logging.warning('mesoDB.read_DB - parallel scan failed, reading in a single process: {}'.format(e))
+        categories = self.registry.categories()
+        data = []
+        for path in paths:
+            data_hour = self.read_hour(path, stids=stids, columns=columns)
+            bounds = self.hour_bounds(path, start_utc, end_utc)
+            if bounds is not None:
+                data_hour = self.trim_hour(data_hour, bounds)
+            # concatenate the station IDs of the hours instead of categoricals with different categories
+            data_hour = data_hour.copy(deep=False)
+            data_hour['STID'] = station_codes(data_hour['STID'], categories.categories)
+            data.append(data_hour)
+        if not len(data):
+            return pd.DataFrame([])
+        # variables missing in some hours are filled with float64 NaN
+        return compact_observations(pd.concat(data, ignore_index=True), categories)
+
+    # Return number of processes to read hour files with, 1 reads them in this process. Short queries are read in
+    # this process, where starting the processes would take longer than reading the files.
+    #
+    # @ Param paths - paths of the hour files
+    #
+    def scan_workers(self, paths):
+        if not self.scan_processes or self.scan_processes <= 1:
+            return 1
+        return max(1, min(self.scan_processes, len(paths)//max(self.scan_hours, 1)))
+
+    # Read hour files in parallel processes. Each process reads ranges of consecutive hours applying the station and
+    # time filters, and sends back the observations as column arrays that are copied into the result columns.
+    #
+    # @ Param paths - paths of the hour files
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    # @ Param start_utc - start datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param end_utc - end datetime at UTC, None if the hours do not need to be trimmed
+    # @ Param columns - list of columns to read, None reads all of them
+    # @ Param workers - number of processes
+    #
+    def scan_DB(self, paths, stids, start_utc=None, end_utc=None, columns=None, workers=2):
+        logging.debug('mesoDB.scan_DB - reading {} hour files with {} processes'.format(len(paths), workers))
+        categories = self.registry.categories()
+        hours = [(path, self.hour_bounds(path, start_utc, end_utc)) for path in paths]
+        stids = None if stids is None else [str(s) for s in stids]
+        # a few ranges per process, so the processes finishing first take the remaining ones
+        ranges = [r for r in np.array_split(np.arange(len(hours)), 4*workers) if len(r)]
+        metrics.inc('files.read', len(paths))
+        with metrics.timer('stage.scan'):
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(scan_hours, self.storage.name, self.folder_path, [hours[k] for k in r], stids,
+                                       columns, len(categories.categories)) for r in ranges]
+                parts = [future.result() for future in futures]
+        return arrays_2_df(concat_arrays(parts), categories)
+
     # Checks if datetime is in realtime interval
     #
     # @ Param utc_datetime - UTC datetime object
@@ -225,6 +558,15 @@ class mesoDB(object):
         now = datetime.datetime.now(datetime.timezone.utc)
         return (now - utc_datetime).total_seconds()/60 <= self.realtime_length
 
+    # Add the new stations to the station registry and the times their observations were seen
+    #
+    # @ Param sites - dataframe with stations
+    # @ Param data - dataframe with observations of the stations
+    #
+    def save_sites(self, sites, data=None):
+        logging.debug('mesoDB.save_sites - updating stations')
+        self.registry.add(sites, data)
+
     # Save data from mesowest to the local database
     #
     # @ Param data - dataframe with fuel moisture data
@@ -233,30 +575,55 @@ class mesoDB(object):
     # @ Param end_utc - end datetime of request at UTC
     #
     def save_to_DB(self, data, sites, start_utc, end_utc):
-        logging.debug('mesoDB.save_to_DB - updating stations')
         if len(data) > 0 and len(sites) > 0:
-            sts_pd = self.sites()
-            sts_pd = sts_pd.append(sites[~sites.index.isin(sts_pd.index)])
-            sts_pd.to_pickle(self.stations_path)
-            while start_utc <= end_utc:
-                data_hour = data[data['datetime'].apply(meso_time) == meso_time(start_utc)]
+            with metrics.timer('stage.save_sites'):
+                self.save_sites(sites, data)
+            with metrics.timer('stage.hour_groups'):
+                groups = hour_groups(data)
+            # group the rows of the stations of each state together so queries only read their row ranges
+            order = self.station_index().ordering()
+            hours = []
+            # the hour of end_utc is not complete, it belongs to the next request
+            while start_utc < end_utc:
+                data_hour = groups.get(pd.Timestamp(start_utc).floor('h'), data.iloc[:0])
                 hour_path = self.hour_path(start_utc)
+                metrics.inc('files.written')
+                metrics.inc('rows.written', len(data_hour))
+                t0 = time.perf_counter()
                 if self.is_realtime(start_utc):
-                    ensure_dir(hour_path + '_tmp')
-                    data_hour.reset_index(drop=True).to_pickle(hour_path + '_tmp')
+                    self.storage.write(data_hour, hour_path + '_tmp', order)
+                    self.cache.invalidate(hour_path + '_tmp')
+                    self.manifest.set(start_utc, REALTIME)
                 else:
-                    ensure_dir(hour_path)
-                    data_hour.reset_index(drop=True).to_pickle(hour_path)
-                    if osp.exists(hour_path + '_tmp'):
-                        os.remove(hour_path + '_tmp')
+                    self.storage.write(data_hour, hour_path, order)
+                    self.storage.remove(hour_path + '_tmp')
+                    self.cache.invalidate(hour_path)
+                    self.cache.invalidate(hour_path + '_tmp')
+                    self.manifest.set(start_utc, COMPLETE)
+                metrics.observe('stage.write_file', time.perf_counter() - t0)
+                hours.append(start_utc)
                 start_utc += datetime.timedelta(hours=1)
+            # keep the statistics of the hours written up to date
+            with metrics.timer('stage.rollups'):
+                self.rollups.update(data, hours)
+        else:
+            # no data returned, remember the hours already out of the realtime interval
+            while start_utc < end_utc:
+                if not self.is_realtime(start_utc):
+                    self.manifest.set(start_utc, EMPTY)
+                start_utc += datetime.timedelta(hours=1)
+        with metrics.timer('stage.manifest'):
+            self.manifest.save()
 
     # Call MesoWest
     #
     # @ Param start_utc - start datetime of request at UTC
     # @ Param end_utc - end datetime of request at UTC
+    # @ Param meso - MesoWest client to use, None uses the current one
     #
-    def run_meso(self, start_utc, end_utc):
+    def run_meso(self, start_utc, end_utc, meso=None):
+        if meso is None:
+            meso = self.meso
         country = self.update.get('country')
         state = self.update.get('state')
         lat1,lat2,lon1,lon2 = check_coords(self.update.get('latitude1'), 
@@ -265,55 +632,299 @@ class mesoDB(object):
                                         self.update.get('longitude2'))
         if country != None:
             logging.debug('mesoDB.run_meso - retrieving for country={}'.format(country))
-            mesoData = self.meso.timeseries(start=meso_time(start_utc), 
-                                            end=meso_time(end_utc), 
+            mesoData = meso.timeseries(start=meso_time(start_utc, exact=True), 
+                                            end=meso_time(end_utc, exact=True), 
                                             country=country,
-                                            vars='fuel_moisture')
+                                            vars=','.join(self.variables))
         elif state != None:
             logging.debug('mesoDB.run_meso - retrieving for state={}'.format(state))
-            mesoData = self.meso.timeseries(start=meso_time(start_utc), 
-                                            end=meso_time(end_utc), 
+            mesoData = meso.timeseries(start=meso_time(start_utc, exact=True), 
+                                            end=meso_time(end_utc, exact=True), 
                                             state=state,
-                                            vars='fuel_moisture')
+                                            vars=','.join(self.variables))
         elif lat1 != None:
             bbox = [lon1,lat1,lon2,lat2]
             logging.debug('mesoDB.run_meso - retrieving for bbox={}'.format(bbox))
-            mesoData = self.meso.timeseries(start=meso_time(start_utc), 
-                                            end=meso_time(end_utc), 
+            mesoData = meso.timeseries(start=meso_time(start_utc, exact=True), 
+                                            end=meso_time(end_utc, exact=True), 
                                             bbox=bbox,
-                                            vars='fuel_moisture')
+                                            vars=','.join(self.variables))
         else:
             logging.debug('mesoDB.run_meso - retrieving for country={}'.format(country))
-            mesoData = self.meso.timeseries(start=meso_time(start_utc), 
-                                            end=meso_time(end_utc), 
+            mesoData = meso.timeseries(start=meso_time(start_utc, exact=True), 
+                                            end=meso_time(end_utc, exact=True), 
                                             country='us',
-                                            vars='fuel_moisture')
+                                            vars=','.join(self.variables))
         return mesoData
 
-    # Try different tokens for MesoWest
+    # Append new observations of realtime hours to their _tmp files
+    #
+    # @ Param data - dataframe with observations
+    # @ Param sites - dataframe with stations
+    #
+    def append_to_DB(self, data, sites):
+        if not len(data):
+            return 0
+        self.save_sites(sites, data)
+        order = self.station_index().ordering()
+        appended = 0
+        for hour,data_hour in sorted(hour_groups(data).items()):
+            hour = hour.to_pydatetime()
+            if self.manifest.get(hour) in (COMPLETE, EMPTY):
+                continue
+            path = self.hour_path(hour) + '_tmp'
+            n = self.storage.append_hour(data_hour, path, order)
+            self.realtime_hours.add(hour)
+            self.manifest.set(hour, REALTIME)
+            if n:
+                self.cache.invalidate(path)
+                self.rollups.update(self.storage.read(path), [hour])
+            appended += n
+        self.manifest.save()
+        return appended
+
+    # Replace the realtime hours followed by the realtime ingestion that left the realtime interval by their final files
+    #
+    def finalize_realtime(self):
+        order = None
+        for hour in sorted(self.realtime_hours):
+            if self.is_realtime(hour):
+                continue
+            path = self.hour_path(hour)
+            if self.storage.exists(path + '_tmp'):
+                if order is None:
+                    order = self.station_index().ordering()
+                logging.info('mesoDB.finalize_realtime - finalizing hour {}'.format(hour))
+                self.storage.finalize(path + '_tmp', path, order)
+                self.cache.invalidate(path)
+                self.cache.invalidate(path + '_tmp')
+                self.manifest.set(hour, COMPLETE)
+            else:
+                self.manifest.set(hour, EMPTY)
+            self.realtime_hours.discard(hour)
+        self.manifest.save()
+
+    # Poll MesoWest once for the observations newer than the ones saved in the realtime hours, appending them to the
+    # realtime hours, finalizing the hours that left the realtime interval and filling the missing hours before it
+    #
+    # @ Param backfill_hours - hours before the realtime interval checked for missing hours
+    #
+    def ingest_realtime(self, backfill_hours=24):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.manifest.load()
+        # first hour inside the realtime interval
+        window_start = (now - datetime.timedelta(minutes=self.realtime_length)).replace(minute=0,second=0,microsecond=0)
+        if not self.is_realtime(window_start):
+            window_start += datetime.timedelta(hours=1)
+        # latest observation saved in the realtime hours
+        since = None
+        hour = window_start
+        while hour <= now:
+            path = self.hour_path(hour) + '_tmp'
+            if self.manifest.get(hour) == REALTIME and self.storage.exists(path):
+                self.realtime_hours.add(hour)
+                times = self.read_hour(path, columns=['STID','datetime'])['datetime']
+                if len(times):
+                    since = times.max() if since is None else max(since, times.max())
+            hour += datetime.timedelta(hours=1)
+        # observations can arrive late, fetch again the last minutes saved
+        start_utc = window_start
+        if since is not None:
+            start_utc = max(window_start, since.to_pydatetime() - datetime.timedelta(minutes=self.realtime_overlap))
+        data,sites = self.try_meso(start_utc, now)
+        appended = self.append_to_DB(data, sites)
+        logging.info('mesoDB.ingest_realtime - appended {} of {} observations from {} to {}'.format(appended, len(data), start_utc, now))
+        self.finalize_realtime()
+        # hours before the realtime interval not in the database
+        self.backfill(self.plan_update(window_start - datetime.timedelta(hours=backfill_hours), window_start))
+        metrics.inc('rows.appended', appended)
+        metrics.flush()
+        return appended
+
+    # Run the realtime ingestion polling MesoWest periodically
+    #
+    # @ Param poll - seconds between polls
+    # @ Param polls - number of polls, None runs forever
+    #
+    def run_realtime(self, poll=300, polls=None):
+        logging.info('mesoDB.run_realtime - polling MesoWest every {} seconds'.format(poll))
+        n = 0
+        while polls is None or n < polls:
+            t0 = time.time()
+            try:
+                self.ingest_realtime()
+            except mesoDBError as e:
+                logging.error('mesoDB.run_realtime - poll failed: {}'.format(e))
+            except (splitError, transportError, OSError) as e:
+                # timeouts and network errors are transient, the hours missing are fetched by the next poll
+                metrics.inc('realtime.poll_errors')
+                logging.warning('mesoDB.run_realtime - poll failed, retrying in the next poll: {}'.format(e))
+            n += 1
+            if polls is None or n < polls:
+                time.sleep(max(0., poll - (time.time() - t0)))
+
+    # Return description of the region of the MesoWest requests
+    #
+    def update_region(self):
+        country = self.update.get('country')
+        state = self.update.get('state')
+        lat1,lat2,lon1,lon2 = check_coords(self.update.get('latitude1'), 
+                                        self.update.get('latitude2'), 
+                                        self.update.get('longitude1'), 
+                                        self.update.get('longitude2'))
+        if country != None:
+            return 'country={}'.format(country.lower())
+        elif state != None:
+            return 'state={}'.format(state.lower())
+        elif lat1 != None:
+            return 'bbox={},{},{},{}'.format(lon1,lat1,lon2,lat2)
+        return 'country=us'
+
+    # Try the healthy tokens for MesoWest, using the less loaded ones first
     #
     # @ Param start_utc - start datetime of request at UTC
     # @ Param end_utc - end datetime of request at UTC
     #
     def try_meso(self, start_utc, end_utc):
         logging.debug('mesoDB.try_meso - getting data from {} to {}'.format(start_utc, end_utc))
+        hours = (end_utc - start_utc).total_seconds()/3600.
+        tried = set()
+        while True:
+            try:
+                too_large = None
+                with self.scheduler.use(exclude=tried, limit=self.token_workers) as (token,meso):
+                    tried.add(token)
+                    metrics.inc('api.calls')
+                    try:
+                        t0 = time.perf_counter()
+                        mesoData = self.run_meso(start_utc, end_utc, meso)
+                        seconds = time.perf_counter() - t0
+                        metrics.observe('stage.fetch', seconds)
+                    except Exception as e:
+                        metrics.inc('api.errors')
+                        # requests too large are not a failure of the token
+                        if not split_worthy(e):
+                            raise
+                        too_large = e
+                if too_large is not None:
+                    raise splitError('mesoDB.try_meso - request from {} to {} too large: {}'.format(start_utc, end_utc, too_large))
+                logging.info('mesoDB.try_meso - re-packing data from {} to {}'.format(start_utc, end_utc))
+                with metrics.timer('stage.parse'):
+                    data,sites = meso_data_2_df(mesoData, self.variables)
+                metrics.inc('rows.parsed', len(data))
+                self.tuner.observe(self.update_region(), hours, len(data), seconds)
+                return data,sites
+            except splitError:
+                raise
+            except tokenError:
+                break
+            except Exception as e:
+                if token_failure(e) == 'quota':
+                    logging.warning('mesoDB.try_meso - token {} failed, probably full for the month, check usage at https://myaccount.synopticdata.com/#payments.'.format(self.tokens.index(token)+1))
+                else:
+                    logging.warning('mesoDB.try_meso - token {} failed'.format(self.tokens.index(token)+1))
+                logging.warning('mesoDB.try_meso - exception: {}'.format(e))
+        raise mesoDBError('mesoDB.try_meso - all the tokens failed or are out of quota. Please, add a token or try it again later.')
+
+    # Plan the minimal MesoWest requests needed to update the local database merging contiguous missing hours
+    #
+    # @ Param start_utc - start datetime of request at UTC
+    # @ Param end_utc - end datetime of request at UTC
+    # @ Param max_span - maximum length of a request in hours, None merges all the contiguous missing hours
+    #
+    def plan_update(self, start_utc, end_utc, max_span=None):
+        chunks = self.manifest.gaps(start_utc, end_utc, max_span or float('inf'))
+        logging.info('mesoDB.plan_update - {} intervals needed from {} to {}'.format(len(chunks), start_utc, end_utc))
+        return chunks
+
+    # Save the fetched chunks to the local database, writer stage of the backfill
+    #
+    # @ Param writes - queue of fetched chunks, None ends the stage
+    # @ Param errors - list where to report the exceptions raised
+    #
+    def write_chunks(self, writes, errors):
+        while True:
+            chunk = writes.get()
+            if chunk is None:
+                break
+            if len(errors):
+                continue
+            data,sites,start_utc,end_utc = chunk
+            try:
+                logging.info('mesoDB.write_chunks - saving data from {} to {}'.format(start_utc, end_utc))
+                with metrics.timer('stage.save_to_DB'):
+                    self.save_to_DB(data,sites,start_utc,end_utc)
+            except Exception as e:
+                errors.append(e)
+
+    # Cut the planned requests in requests of the length chosen from the previous requests of the region
+    #
+    # @ Param chunks - list of (start_utc, end_utc) requests
+    # @ Param region - description of the region of the requests
+    #
+    def cut_chunks(self, chunks, region):
+        # national requests are huge, start with shorter ones until their size is known
+        default = 6 if region.startswith('country') else 24
+        for start_utc,end_utc in chunks:
+            while start_utc < end_utc:
+                span = self.max_span or self.tuner.span(region, default)
+                stop = min(end_utc, start_utc.replace(minute=0,second=0,microsecond=0) + datetime.timedelta(hours=span))
+                yield start_utc,stop
+                start_utc = stop
+
+    # Fetch the chunks from MesoWest using a pool of workers and save them in a separate writer stage,
+    # the requests too large to be answered are split in halves
+    #
+    # @ Param chunks - list of (start_utc, end_utc) requests
+    # @ Param adaptive - cut the requests with the length chosen from the previous requests
+    #
+    def backfill(self, chunks, adaptive=True):
+        if not len(chunks):
+            return
+        region = self.update_region()
+        workers = max(1, self.workers if adaptive else min(self.workers, len(chunks)))
+        logging.info('mesoDB.backfill - fetching {} intervals using {} workers'.format(len(chunks), workers))
+        planned = self.cut_chunks(chunks, region) if adaptive else iter(chunks)
+        splits = deque()
+        errors = []
+        writes = queue.Queue(maxsize=workers)
+        writer = threading.Thread(target=self.write_chunks, args=(writes, errors))
+        writer.start()
+        pool = ThreadPoolExecutor(max_workers=workers)
         try:
-            mesoData = self.run_meso(start_utc, end_utc)
-            logging.info('mesoDB.try_meso - re-packing data from {} to {}'.format(start_utc, end_utc))
-            return meso_data_2_df(mesoData) 
-        except Exception as e:
-            logging.warning('mesoDB.try_meso - token 1 failed, probably full for the month, check usage at https://myaccount.synopticdata.com/#payments.')
-            logging.warning('mesoDB.try_meso - exception: {}'.format(e))
-            for tn,token in enumerate(self.tokens[1:]):
-                try:
-                    self.meso = Meso(token)
-                    mesoData = self.run_meso(start_utc, end_utc)
-                    logging.info('mesoDB.try_meso - re-packing data from {} to {}'.format(start_utc, end_utc))
-                    return meso_data_2_df(mesoData) 
-                except Exception as e:
-                    logging.warning('mesoDB.try_meso - token {} failed, probably full for the month, check usage at https://myaccount.synopticdata.com/#payments.'.format(tn+2))
-                    logging.warning('mesoDB.try_meso - exception: {}'.format(e))
-            raise mesoDBError('mesoDB.try_meso - all the tokens failed. Please, add a token or try it again later.')
+            pending = {}
+            while True:
+                # keep a bounded number of requests in flight, split requests first
+                while len(pending) < 2*workers:
+                    chunk = splits.popleft() if len(splits) else next(planned, None)
+                    if chunk is None:
+                        break
+                    start_utc,end_utc = chunk
+                    logging.info('mesoDB.backfill - updating database from {} to {}'.format(start_utc, end_utc))
+                    pending[pool.submit(self.try_meso, start_utc, end_utc)] = (start_utc, end_utc)
+                if not len(pending) or len(errors):
+                    break
+                done,_ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start_utc,end_utc = pending.pop(future)
+                    try:
+                        data,sites = future.result()
+                    except splitError as e:
+                        halves = split_chunk(start_utc, end_utc)
+                        if halves is None:
+                            raise
+                        logging.warning('{}, splitting it'.format(e))
+                        metrics.inc('api.splits')
+                        self.tuner.shrink(region, (end_utc - start_utc).total_seconds()/3600.)
+                        splits.extend(halves)
+                        continue
+                    writes.put((data,sites,start_utc,end_utc))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            writes.put(None)
+            writer.join()
+        if len(errors):
+            raise errors[0]
 
     # Get MesoWest data for time interval hourly
     #
@@ -321,24 +932,7 @@ class mesoDB(object):
     # @ Param end_utc - end datetime of request at UTC
     #
     def get_meso_data_hourly(self, start_utc, end_utc):
-        if (end_utc-start_utc).total_seconds() > 3600.: # larger than an hour, recursion
-            tmp_utc = start_utc + datetime.timedelta(hours=1)
-            if self.hour_file_exists(start_utc):
-                logging.info('mesoDB.get_meso_data_hourly - {} data already exists'.format(self.hour_path(start_utc)))
-            else:
-                logging.info('mesoDB.get_meso_data_hourly - updating database from {} to {}'.format(start_utc, tmp_utc))
-                data,sites = self.try_meso(start_utc,tmp_utc)
-                logging.info('mesoDB.get_meso_data_hourly - saving data from {} to {}'.format(start_utc, tmp_utc))
-                self.save_to_DB(data,sites,start_utc,tmp_utc)
-            self.get_meso_data_hourly(tmp_utc,end_utc)
-        else: # else, no recursion
-            if self.hour_file_exists(start_utc):
-                logging.info('mesoDB.get_meso_data_hourly - {} data already exists'.format(self.hour_path(start_utc)))
-            else:
-                logging.info('mesoDB.get_meso_data_hourly - updating database from {} to {}'.format(start_utc, end_utc))
-                data,sites = self.try_meso(start_utc,end_utc)
-                logging.info('mesoDB.get_meso_data_hourly - saving data from {} to {}'.format(start_utc, end_utc))
-                self.save_to_DB(data,sites,start_utc,end_utc)
+        self.backfill(self.plan_update(start_utc, end_utc, max_span=1), adaptive=False)
 
     # Get MesoWest data for time interval daily
     #
@@ -346,53 +940,180 @@ class mesoDB(object):
     # @ Param end_utc - end datetime of request at UTC
     #
     def get_meso_data_daily(self, start_utc, end_utc):
-        if (end_utc-start_utc).total_seconds()/3600. > 24.: # larger than a day, recursion
-            tmp_utc = start_utc + datetime.timedelta(days=1)
-            if self.day_is_empty(start_utc):
-                logging.info('mesoDB.get_meso_data_daily - updating database from {} to {}'.format(start_utc, tmp_utc))
-                data,sites = self.try_meso(start_utc,tmp_utc)
-                logging.info('mesoDB.get_meso_data_daily - saving data from {} to {}'.format(start_utc, tmp_utc))
-                self.save_to_DB(data,sites,start_utc,tmp_utc)
-            elif not self.day_is_full(start_utc):
-                self.get_meso_data_hourly(start_utc,tmp_utc)
-            else:
-                logging.info('mesoDB.get_meso_data_daily - {} complete day already exists'.format(self.julian_path(start_utc)))
-            self.get_meso_data_daily(tmp_utc,end_utc)
-        else: # else, no recursion
-            if self.day_is_empty(start_utc):
-                logging.info('mesoDB.get_meso_data_daily - updating database from {} to {}'.format(start_utc, end_utc))
-                data,sites = self.try_meso(start_utc,end_utc)
-                logging.info('mesoDB.get_meso_data_daily - saving data from {} to {}'.format(start_utc, end_utc))
-                self.save_to_DB(data,sites,start_utc,end_utc)
-            elif not self.day_is_full(start_utc):
-                self.get_meso_data_hourly(start_utc,end_utc)
-            else:
-                logging.info('mesoDB.get_meso_data_daily - {} complete day already exists'.format(self.julian_path(start_utc)))
+        self.backfill(self.plan_update(start_utc, end_utc, max_span=24), adaptive=False)
     
     # Updates the local database
     #
-    # @ Param start_utc - start datetime of request at UTC
-    # @ Param end_utc - end datetime of request at UTC
-    #
     def update_DB(self):
         start_utc = self.update.get('startTime')
         end_utc = self.update.get('endTime')
         if start_utc is None or end_utc is None or (end_utc-start_utc).total_seconds() <= 60:
             raise mesoDBError('mesoDB.update_DB - times specified are incorrect or time inteval too small')
         logging.info('mesoDB.update_DB - updating data from {} to {}'.format(start_utc, end_utc))
-        tmp_start = (start_utc + datetime.timedelta(days=1)).replace(hour=0,minute=0,second=0,microsecond=0)
-        if end_utc < tmp_start:
-            self.get_meso_data_hourly(start_utc, end_utc)
-            start_utc = end_utc
-        else:
-            if start_utc.hour != 0:
-                self.get_meso_data_hourly(start_utc, tmp_start)
-                start_utc = tmp_start
-        tmp_end = end_utc.replace(hour=0,minute=0,second=0,microsecond=0)
-        if (tmp_end-start_utc).total_seconds() > 60:
-            self.get_meso_data_daily(start_utc, tmp_end)
-        if (tmp_end-start_utc).total_seconds() >= 0 and (end_utc-tmp_end).total_seconds() > 60:
-            self.get_meso_data_hourly(tmp_end, end_utc)
+        # reload manifest in case the database was updated from another process
+        self.manifest.load()
+        with metrics.timer('update.update_DB'):
+            self.backfill(self.plan_update(start_utc, end_utc))
+        metrics.flush()
+
+    # Select station IDs from the user options, None selects all of them
+    #
+    # @ Param params - dictionary of query parameters, None uses db.params
+    #
+    def select_stations(self, params=None):
+        if params is None:
+            params = self.params
+        state = params.get('state')
+        latitude1 = params.get('latitude1')
+        latitude2 = params.get('latitude2')
+        longitude1 = params.get('longitude1')
+        longitude2 = params.get('longitude2')
+        latitude = params.get('latitude')
+        longitude = params.get('longitude')
+        radius = params.get('radius')
+        nearest = params.get('nearest')
+        stations = params.get('stations')
+        # Check if the coordinates are valid
+        lat1,lat2,lon1,lon2 = check_coords(latitude1, latitude2, longitude1, longitude2)
+        # Filter stations with user options using the station spatial index
+        stidLoc = None
+        if lat1 != None:
+            stidLoc = self.station_index().bbox(lat1, lat2, lon1, lon2)
+        elif latitude != None and longitude != None and nearest:
+            stidLoc,_ = self.station_index().nearest(latitude, longitude, nearest)
+        elif latitude != None and longitude != None and radius:
+            stidLoc = self.station_index().radius(latitude, longitude, radius)
+        elif state != None:
+            stidLoc = self.station_index().state(state)
+        if stations is not None:
+            # explicit list of stations, inside the other selection if any
+            stations = np.array([stations] if isinstance(stations, str) else stations, dtype=str).astype(object)
+            stidLoc = stations if stidLoc is None else stidLoc[np.isin(np.asarray(stidLoc, dtype=str), stations.astype(str))]
+        if stidLoc is not None:
+            # stations without observations in the time interval are not read
+            stidLoc = self.registry.active(params.get('startTime'), params.get('endTime'), stidLoc)
+        return stidLoc
+
+    # Select columns to read from the user options, None selects all of them
+    #
+    # @ Param params - dictionary of query parameters, None uses db.params
+    #
+    def select_columns(self, params=None):
+        variables = (self.params if params is None else params).get('variables')
+        if variables is None:
+            return None
+        if isinstance(variables,str):
+            variables = [variables]
+        return ['STID','datetime'] + [meso_columns.get(v, v) for v in variables]
+
+    # Gets statistics of the observations per station and hour or day from the rollups of the local database,
+    # periods are included if they start inside the time interval
+    #
+    # @ Param freq - hourly (h) or daily (D) statistics
+    # @ Param by - group statistics by station (station) or by state (state)
+    #
+    def get_rollups(self, freq='D', by='station'):
+        startTime = self.params.get('startTime')
+        endTime = self.params.get('endTime')
+        if self.params.get('updateDB'):
+            # Update database
+            self.update_DB()
+        rollups = self.rollups.query(startTime, endTime, freq=freq, stids=self.select_stations())
+        if not len(rollups):
+            return rollups
+        if by == 'state':
+            states = self.sites()['STATE'].astype(str).str.upper()
+            rollups = combine_rollups(rollups.assign(STATE=rollups['STID'].map(states).values), ['STATE','datetime'])
+            rollups = rollups.drop(columns=[column for column in rollups.columns if column.endswith('_last')])
+        elif by != 'station':
+            raise mesoDBError('mesoDB.get_rollups - by has to be station or state, not {}'.format(by))
+        return add_means(rollups)
+
+    # Verify the hour files of the local database against their checksums. If repair is set, the invalid hour files are
+    # removed and marked as missing, so the next update fetches them again. Returns the paths of the invalid hour files.
+    #
+    # @ Param repair - remove the invalid hour files
+    #
+    def verify_DB(self, repair=False):
+        paths = sorted(self.storage.list_hours(self.folder_path))
+        logging.info('mesoDB.verify_DB - verifying {} hour files'.format(len(paths)))
+        invalid = [path for path in paths if not self.storage.verify(path)]
+        for path in invalid:
+            logging.warning('mesoDB.verify_DB - invalid hour file {}'.format(path))
+            if repair:
+                name = osp.basename(path)
+                hour = datetime.datetime.strptime(name[:9], '%Y%j%H').replace(tzinfo=datetime.timezone.utc)
+                self.storage.remove(path)
+                self.cache.invalidate(path)
+                if not self.storage.exists(self.hour_path(hour)):
+                    self.manifest.set(hour, MISSING)
+                    self.rollups.update(pd.DataFrame([]), [hour])
+        if repair and len(invalid):
+            self.manifest.save()
+        return invalid
+
+    # Rebuild the rollups from the hour files of the local database
+    #
+    def rebuild_rollups(self):
+        logging.info('mesoDB.rebuild_rollups - rebuilding rollups of {}'.format(self.folder_path))
+        self.rollups.clear()
+        paths = sorted(self.storage.list_hours(self.folder_path), key=lambda path: path.endswith('_tmp'))
+        # complete files first, so realtime files of hours already complete are skipped
+        days = {}
+        for path in paths:
+            name = osp.basename(path)
+            hour = datetime.datetime.strptime(name[:9], '%Y%j%H').replace(tzinfo=datetime.timezone.utc)
+            days.setdefault(name[:7], {}).setdefault(hour, path)
+        # one update per day
+        for day in sorted(days):
+            hours = sorted(days[day])
+            data = pd.concat([self.storage.read(days[day][hour]) for hour in hours])
+            self.rollups.update(data, hours)
+
+    # Rebuild the first and last times the stations were seen from the hour files of the local database, so the
+    # stations registered before the times were tracked can be skipped by the queries
+    #
+    def rebuild_stations(self):
+        logging.info('mesoDB.rebuild_stations - scanning hour files of {}'.format(self.folder_path))
+        seen = {}
+        for path in self.storage.list_hours(self.folder_path):
+            data = self.storage.read(path, columns=['STID','datetime'])
+            if not len(data):
+                continue
+            times = pd.Series(data['datetime'].values.astype('datetime64[ns]').view(np.int64))
+            times = times.groupby(data['STID'].astype(str).values).agg(['min','max'])
+            for stid,t0,t1 in zip(times.index, times['min'].values, times['max'].values):
+                first,last = seen.get(stid, (t0,t1))
+                seen[stid] = (int(min(first, t0)),int(max(last, t1)))
+        self.registry.reset_seen(seen)
+
+    # Iterate over data from local database in time order, one chunk of hours at a time
+    #
+    # @ Param chunk - length of the chunks as a pandas frequency string (for instance, 1h or 1D)
+    #
+    def iter_DB(self, chunk='1D'):
+        startTime = self.params.get('startTime')
+        endTime = self.params.get('endTime')
+        if self.params.get('updateDB'):
+            # Update database
+            self.update_DB()
+        stidLoc = self.select_stations()
+        columns = self.select_columns()
+        # Group hour files by chunk
+        chunks = []
+        for hour,path in self.hour_files(startTime, endTime):
+            key = pd.Timestamp(hour).floor(chunk)
+            if not len(chunks) or chunks[-1][0] != key:
+                chunks.append((key, []))
+            chunks[-1][1].append(path)
+        for k,(key,paths) in enumerate(chunks):
+            # Only the first and last chunks can have dates outside of the interval
+            if k == 0 or k == len(chunks)-1:
+                data = self.read_DB(paths, stidLoc, startTime, endTime, columns)
+            else:
+                data = self.read_DB(paths, stidLoc, columns=columns)
+            if len(data):
+                yield data if self.params.get('compact', True) else legacy_observations(data)
 
     # Gets mesowest data from local database
     #
@@ -400,62 +1121,21 @@ class mesoDB(object):
         # Load parameters for getting data
         startTime = self.params.get('startTime')
         endTime = self.params.get('endTime')
-        state = self.params.get('state')
-        latitude1 = self.params.get('latitude1')
-        latitude2 = self.params.get('latitude2')
-        longitude1 = self.params.get('longitude1')
-        longitude2 = self.params.get('longitude2')
         makeFile = self.params.get('makeFile')
         updateDB = self.params.get('updateDB')
-        # Check if the coordinates are valid
-        lat1,lat2,lon1,lon2 = check_coords(latitude1, latitude2, longitude1, longitude2)
 
         if updateDB:
             # Update database
             self.update_DB()
 
-        # Load station.pkl data and filter user options
-        df_sites = self.sites()
-        if lat1 != None:
-            df_sites['LATITUDE'] = df_sites['LATITUDE'].astype(float)
-            df_sites['LONGITUDE'] = df_sites['LONGITUDE'].astype(float)
-            stidLoc = df_sites[np.logical_and(df_sites['LATITUDE'].between(lat1, lat2, inclusive=True),
-                                            df_sites['LONGITUDE'].between(lon1, lon2, inclusive=True))].index.values
-        elif state != None:
-            stidLoc = df_sites[df_sites['STATE'].str.lower() == state.lower()].index.values
-        # Create an empty dataframe which will hold all the data requested
-        data = []
-        # Create temporary times to specify files that need to be read
-        tmp_start = startTime.replace(minute=0,second=0,microsecond=0)
-        tmp_end = (endTime+datetime.timedelta(hours=1)).replace(minute=0,second=0,microsecond=0)
-        # While not at the end of time interval
-        while tmp_start < tmp_end:
-            # Read local file with data
-            path = self.hour_path(tmp_start)
-            if self.hour_file_exists(tmp_start):
-                df_local = pd.read_pickle(path)
-            elif osp.exists(path + "_tmp"):
-                df_local = pd.read_pickle(path + "_tmp")
-            else:
-                logging.warning('mesoDB.get_DB - could not find data for time {}'.format(tmp_start))
-                tmp_start = tmp_start + datetime.timedelta(hours=1)
-                continue
-            # Filter user options
-            if lat1 != None:
-                data.append(df_local[df_local['STID'].isin(stidLoc)])
-            elif state != None:
-                data.append(df_local[df_local['STID'].isin(stidLoc)])
-            else:
-                data.append(df_local)
-            # Go to next hour
-            tmp_start = tmp_start + datetime.timedelta(hours=1)
-        
-        # Make sure there are no dates outside of interval (starting and ending minutes) and cleanup index
-        if len(data) > 0:
-            df_final = pd.concat(data)
-            df_final = df_final[df_final['datetime'].between(startTime, endTime)].reset_index(drop=True)
-        else:
-            df_final = pd.DataFrame([])
+        # Read hour files filtering user options
+        with metrics.timer('query.get_DB'):
+            paths = [path for _,path in self.hour_files(startTime, endTime)]
+            df_final = self.read_DB(paths, self.select_stations(), startTime, endTime, self.select_columns())
+        metrics.inc('rows.read', len(df_final))
+        if not self.params.get('compact', True):
+            # STID strings and float64 variables like the databases before the compact schema
+            df_final = legacy_observations(df_final)
         
         # If makeFile variable is true, create a pickle file with the requested data
         if makeFile:
@@ -466,12 +1146,150 @@ class mesoDB(object):
             df_final.to_pickle(osp.join(self.folder_path,filename + '.pkl'), index=False, date_format='%Y-%m-%d')
         
         return df_final
+
+    # Gets mesowest data of many queries from the local database, reading each hour file needed by the queries once and
+    # splitting its rows between them. Each query is a dictionary with the query parameters that replace the ones of
+    # db.params (startTime, endTime, state, latitude1, latitude2, longitude1, longitude2, latitude, longitude, radius,
+    # nearest, stations, variables and compact). Returns the list of dataframes of the queries.
+    #
+    # @ Param queries - list of dictionaries of query parameters
+    #
+    def get_DB_batch(self, queries):
+        if self.params.get('updateDB'):
+            # Update database
+            self.update_DB()
+
+        with metrics.timer('query.get_DB_batch'):
+            categories = self.registry.categories()
+            # Plan the hour files of all the queries
+            specs = []
+            plan = {}
+            for k,query in enumerate(queries):
+                params = dict(self.params, **query)
+                stids = self.select_stations(params)
+                lookup = None
+                count = None
+                if stids is not None:
+                    count = len(set(np.asarray(stids, dtype=str)))
+                    # stations of the query by station ID, the last position stands for the stations registered later
+                    ids = self.registry.get_ids(stids)
+                    lookup = np.zeros(len(categories.categories)+1, dtype=bool)
+                    lookup[ids[ids >= 0]] = True
+                spec = {'start': params.get('startTime'), 'end': params.get('endTime'), 'stids': stids, 'count': count,
+                        'lookup': lookup, 'columns': self.select_columns(params), 'compact': params.get('compact', True), 'paths': []}
+                specs.append(spec)
+                if stids is not None and not len(stids):
+                    continue
+                for hour,path in self.hour_files(spec['start'], spec['end']):
+                    spec['paths'].append(path)
+                    plan.setdefault((hour, path), []).append(k)
+            metrics.inc('batch.queries', len(queries))
+            metrics.inc('batch.files', len(plan))
+            pieces = [[] for _ in specs]
+            if getattr(self.storage, 'zero_copy', False):
+                # the memory maps share the pages of the hour files, each query copies its rows straight into its result
+                for spec,frames in zip(specs, pieces):
+                    if len(spec['paths']):
+                        frames.append(self.read_DB(spec['paths'], spec['stids'], spec['start'], spec['end'], spec['columns']))
+                plan = {}
+            # Read each hour file once with the stations and columns of all its queries
+            for (hour,path),users in sorted(plan.items()):
+                stids = None
+                if all([specs[k]['stids'] is not None for k in users]):
+                    stids = np.unique(np.concatenate([np.asarray(specs[k]['stids'], dtype=str) for k in users])).astype(object)
+                columns = None
+                if all([specs[k]['columns'] is not None for k in users]):
+                    columns = list(dict.fromkeys([c for k in users for c in specs[k]['columns']]))
+                data = self.read_DB([path], stids, columns=columns)
+                if not len(data):
+                    continue
+                # station IDs instead of the categorical, so the pieces are concatenated as integers
+                ids = data['STID'].cat.codes.values.astype(np.int32)
+                times = data['datetime'].values.astype('datetime64[ns]').view(np.int64)
+                data = data.copy(deep=False)
+                data['STID'] = ids
+                for k in users:
+                    spec = specs[k]
+                    keep = None
+                    # queries with all the stations read do not need to be filtered
+                    if spec['stids'] is not None and (stids is None or len(stids) != spec['count']):
+                        keep = spec['lookup'][np.minimum(ids, len(spec['lookup'])-1)]
+                    bounds = self.hour_bounds(path, spec['start'], spec['end'])
+                    if bounds is not None:
+                        inside = (times >= bounds[0]) & (times <= bounds[1])
+                        keep = inside if keep is None else keep & inside
+                    piece = data if keep is None else data.iloc[np.flatnonzero(keep)]
+                    if spec['columns'] is not None and columns != spec['columns']:
+                        piece = piece[[c for c in spec['columns'] if c in piece]]
+                    pieces[k].append(piece)
+            # Put together the dataframe of each query
+            categories = self.registry.categories()
+            results = []
+            for spec,frames in zip(specs, pieces):
+                if not len(frames):
+                    results.append(pd.DataFrame([]))
+                    continue
+                data = compact_observations(pd.concat(frames) if len(frames) > 1 else frames[0], categories)
+                data.index = pd.RangeIndex(len(data))
+                metrics.inc('rows.read', len(data))
+                results.append(data if spec['compact'] else legacy_observations(data))
+        return results
+
+    # Interpolates a variable of the local database to the points of a grid, returning the start of each period and an
+    # array (periods x grid shape) with the mean values of the stations in each period interpolated, NaN where there are
+    # no stations. The interpolation weights are cached and reused while the stations with observations do not change.
+    #
+    # @ Param lats,lons - latitudes and longitudes of the grid in WGS84 degrees, 1D arrays as the axes of a regular grid
+    #                     or arrays with the coordinates of each grid point
+    # @ Param variable - MesoWest variable to interpolate
+    # @ Param freq - length of the periods as a pandas frequency string (for instance, 1h or 1D)
+    # @ Param method - idw (inverse distance weighting of the k nearest stations) or nearest (nearest station with a value)
+    # @ Param k - number of nearest stations of each grid point
+    # @ Param power - power of the inverse distance weights
+    # @ Param max_distance - stations further than this distance in km are not used, None uses all of them
+    #
+    def get_grid(self, lats, lons, variable='fuel_moisture', freq='h', method='idw', k=8, power=2., max_distance=None):
+        startTime = self.params.get('startTime')
+        endTime = self.params.get('endTime')
+        if self.params.get('updateDB'):
+            # Update database
+            self.update_DB()
+        lats,lons = grid_coords(lats, lons)
+        column = meso_columns.get(variable, variable)
+        periods = pd.date_range(pd.Timestamp(startTime).floor(freq), endTime, freq=freq)
+        with metrics.timer('query.get_grid'):
+            paths = [path for _,path in self.hour_files(startTime, endTime)]
+            data = self.read_DB(paths, self.select_stations(), startTime, endTime, ['STID','datetime',column])
+            if not len(data) or column not in data:
+                return periods,np.full((len(periods),) + lats.shape, np.nan, dtype=np.float32)
+            # station IDs of the observations, the codes of STID
+            ids = data['STID'].cat.codes.values
+            values = data[column].values
+            times = data['datetime'].values.astype('datetime64[ns]').view(np.int64)
+            # stations with values and coordinates
+            sites = self.sites()
+            site_lats = pd.to_numeric(sites['LATITUDE'], errors='coerce').values.astype(float)
+            site_lons = pd.to_numeric(sites['LONGITUDE'], errors='coerce').values.astype(float)
+            located = sites['ID'].values[np.isfinite(site_lats) & np.isfinite(site_lons)]
+            stations = np.intersect1d(ids[np.isfinite(values)], located)
+            pos = pd.Index(sites['ID'].values).get_indexer(stations)
+            with metrics.timer('stage.grid_weights'):
+                weights = self.grid_weights.get(lats, lons, stations, site_lats[pos], site_lons[pos], method=method,
+                                                k=k, power=power, max_distance=max_distance)
+            with metrics.timer('stage.grid_apply'):
+                grid = weights.apply(period_means(ids, times, values, periods, stations))
+        return periods,grid
     
     
 # Runs if this is the file being used
 #
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-    token = input('What token do you want to use?')
-    meso = mesoDB(mesoToken=token)
-    meso.update_DB()
+    if len(sys.argv) > 1 and sys.argv[1] == 'realtime':
+        # python mesoDB.py realtime [folder_path] [poll_seconds]
+        meso = mesoDB(*sys.argv[2:3])
+        meso.run_realtime(poll=float(sys.argv[3]) if len(sys.argv) > 3 else 300)
+    else:
+        token = input('What token do you want to use?')
+        meso = mesoDB(mesoToken=token)
+        meso.update_DB()
@@ -0,0 +1,195 @@
+# MesoDB Metrics
+
+# Libraries
+#
+import bisect
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+try:
+    from .locks import *
+except:
+    from locks import *
+
+# Upper bounds in seconds of the buckets of the timing histograms, from 10 microseconds to about 20 minutes
+BUCKETS = [1e-5*2**k for k in range(27)]
+# Context manager returned by the timers when the metrics are disabled
+NULL_TIMER = nullcontext()
+
+# Timer context manager recording its duration into a histogram
+#
+class metricsTimer(object):
+
+    # Timer constructor
+    #
+    # @ Param registry - metrics registry
+    # @ Param name - name of the histogram
+    #
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.perf_counter() - self.t0)
+
+# Counters and timing histograms of the update and query paths. Disabled by default, when every call returns
+# without doing anything. Enabled setting the enabled attribute or the MESODB_METRICS environment variable.
+#
+class metricsRegistry(object):
+
+    # Metrics registry constructor
+    #
+    # @ Param enabled - record the metrics
+    # @ Param export_path - path of the file written by flush (.json for JSON, Prometheus text format otherwise)
+    #
+    def __init__(self, enabled=False, export_path=None):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.lock = threading.Lock()
+        self.reset()
+
+    # Forget all the metrics recorded
+    #
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    # Add to a counter
+    #
+    # @ Param name - name of the counter
+    # @ Param value - value added
+    #
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Record a duration in a timing histogram
+    #
+    # @ Param name - name of the histogram
+    # @ Param seconds - duration in seconds
+    #
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = {'count': 0, 'sum': 0., 'min': seconds, 'max': seconds,
+                                                'buckets': [0]*(len(BUCKETS)+1)}
+            hist['count'] += 1
+            hist['sum'] += seconds
+            hist['min'] = min(hist['min'], seconds)
+            hist['max'] = max(hist['max'], seconds)
+            hist['buckets'][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    # Return context manager timing its block into a histogram
+    #
+    # @ Param name - name of the histogram
+    #
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return metricsTimer(self, name)
+
+    # Return upper bound of the bucket of a quantile of a histogram
+    #
+    # @ Param hist - histogram
+    # @ Param q - quantile between 0 and 1
+    #
+    def quantile(self, hist, q):
+        rank = q*hist['count']
+        total = 0
+        for bound,count in zip(BUCKETS + [hist['max']], hist['buckets']):
+            total += count
+            if total >= rank:
+                return min(bound, hist['max'])
+        return hist['max']
+
+    # Return dictionary with the counters and the summaries of the histograms
+    #
+    def snapshot(self):
+        with self.lock:
+            histograms = {}
+            for name,hist in self.histograms.items():
+                histograms[name] = {'count': hist['count'], 'sum': hist['sum'], 'mean': hist['sum']/hist['count'],
+                                    'min': hist['min'], 'max': hist['max'], 'p50': self.quantile(hist, .5),
+                                    'p90': self.quantile(hist, .9), 'p99': self.quantile(hist, .99)}
+            return {'started': self.started, 'time': time.time(), 'counters': dict(self.counters), 'histograms': histograms}
+
+    # Return metrics in the Prometheus text format
+    #
+    def text(self):
+        lines = []
+        with self.lock:
+            for name,value in sorted(self.counters.items()):
+                lines.append('mesodb_{}_total {}'.format(name.replace('.','_'), value))
+            for name,hist in sorted(self.histograms.items()):
+                name = 'mesodb_{}_seconds'.format(name.replace('.','_'))
+                total = 0
+                for bound,count in zip(BUCKETS, hist['buckets']):
+                    total += count
+                    lines.append('{}_bucket{{le="{:g}"}} {}'.format(name, bound, total))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, hist['count']))
+                lines.append('{}_sum {}'.format(name, hist['sum']))
+                lines.append('{}_count {}'.format(name, hist['count']))
+        return '\n'.join(lines) + '\n'
+
+    # Write metrics to a file replacing it atomically
+    #
+    # @ Param path - path of the file, JSON if it ends with .json and Prometheus text format otherwise
+    #
+    def export(self, path):
+        with atomic_write(path) as tmp:
+            with open(tmp, 'w') as f:
+                if path.endswith('.json'):
+                    json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+                else:
+                    f.write(self.text())
+
+    # Write metrics to the export path if they are enabled and it is set
+    #
+    def flush(self):
+        if self.enabled and self.export_path is not None:
+            try:
+                self.export(self.export_path)
+            except Exception as e:
+                logging.warning('metricsRegistry.flush - could not export metrics to {}: {}'.format(self.export_path, e))
+
+    # Context manager enabling the metrics in its block, writing them to a file at the end and optionally profiling
+    # the block with cProfile
+    #
+    # @ Param path - path of the metrics file, None does not write it
+    # @ Param cprofile - path of the cProfile stats file (readable by pstats), None does not profile
+    #
+    @contextmanager
+    def profile(self, path=None, cprofile=None):
+        enabled = self.enabled
+        self.enabled = True
+        profiler = cProfile.Profile() if cprofile is not None else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(cprofile)
+            self.enabled = enabled
+            if path is not None:
+                self.export(path)
+
+# Metrics shared by all the databases of the process
+metrics = metricsRegistry(enabled=os.environ.get('MESODB_METRICS', '') not in ('', '0'),
+                          export_path=os.environ.get('MESODB_METRICS_PATH'))
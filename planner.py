@@ -0,0 +1,133 @@
+# MesoDB Request Span Planner
+
+# Libraries
+#
+import datetime
+import json
+import logging
+import os.path as osp
+import socket
+import threading
+try:
+    from .locks import *
+except:
+    from locks import *
+
+# HTTP status codes of the MesoWest requests too large to be answered
+SPLIT_STATUS = (413,)
+
+# Error of a request that has to be split in shorter ones
+#
+class splitError(Exception):
+    pass
+
+# Return True if an exception means the request was too large, from the HTTP status of the transport errors or
+# the socket timeouts still failing after the retries of the transport. Rate limits and gateway errors are transient.
+#
+# @ Param error - exception raised by the request
+#
+def split_worthy(error):
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return True
+    if getattr(error, 'status', None) in SPLIT_STATUS:
+        return True
+    return isinstance(getattr(error, 'cause', None), (socket.timeout, TimeoutError))
+
+# Tuner of the length of the MesoWest requests of each region from the observed response sizes and latencies,
+# persisted in the .spans file
+#
+class spanTuner(object):
+
+    # Span tuner constructor
+    #
+    # @ Param folder_path - path of the database
+    # @ Param target_rows - number of observations aimed per request
+    # @ Param target_seconds - seconds aimed per request
+    # @ Param min_span - minimum length of a request in hours
+    # @ Param max_span - maximum length of a request in hours
+    # @ Param alpha - weight of the last observation in the moving averages
+    #
+    def __init__(self, folder_path, target_rows=500000, target_seconds=30., min_span=1, max_span=24*7, alpha=.3):
+        self.path = osp.join(folder_path, '.spans')
+        self.target_rows = target_rows
+        self.target_seconds = target_seconds
+        self.min_span = min_span
+        self.max_span = max_span
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.regions = {}
+        if osp.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.regions = json.load(f)
+            except Exception as e:
+                logging.warning('spanTuner - could not load {}: {}'.format(self.path, e))
+
+    # Save observed rates to disk, the lock has to be held
+    #
+    def save(self):
+        with atomic_write(self.path) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(self.regions, f, sort_keys=True, indent=1)
+
+    # Return length in hours of the next request of a region
+    #
+    # @ Param region - description of the region of the requests
+    # @ Param default - length in hours if nothing was observed for the region yet
+    #
+    def span(self, region, default=24):
+        with self.lock:
+            rates = self.regions.get(region)
+        if rates is None:
+            return default
+        hours = min(self.target_rows/max(rates['rows_per_hour'], 1e-6),
+                    self.target_seconds/max(rates['seconds_per_hour'], 1e-6))
+        return int(max(self.min_span, min(self.max_span, hours)))
+
+    # Record size and latency of a request
+    #
+    # @ Param region - description of the region of the request
+    # @ Param hours - length of the request in hours
+    # @ Param rows - number of observations returned
+    # @ Param seconds - seconds taken by the request
+    #
+    def observe(self, region, hours, rows, seconds):
+        hours = max(hours, 1e-6)
+        with self.lock:
+            rates = self.regions.get(region)
+            if rates is None:
+                rates = {'rows_per_hour': rows/hours, 'seconds_per_hour': seconds/hours, 'requests': 0}
+            else:
+                a = self.alpha
+                rates['rows_per_hour'] = (1-a)*rates['rows_per_hour'] + a*rows/hours
+                rates['seconds_per_hour'] = (1-a)*rates['seconds_per_hour'] + a*seconds/hours
+            rates['requests'] += 1
+            self.regions[region] = rates
+            self.save()
+
+    # Shrink the next requests of a region below the length of a request too large to be answered
+    #
+    # @ Param region - description of the region of the request
+    # @ Param hours - length of the request in hours
+    #
+    def shrink(self, region, hours):
+        half = max(hours/2., 1e-6)
+        with self.lock:
+            rates = self.regions.setdefault(region, {'rows_per_hour': 0., 'seconds_per_hour': 0., 'requests': 0})
+            rates['rows_per_hour'] = max(rates['rows_per_hour'], self.target_rows/half)
+            rates['seconds_per_hour'] = max(rates['seconds_per_hour'], self.target_seconds/half)
+            self.save()
+
+# Split a request in two halves at an hour boundary, None if it cannot be split
+#
+# @ Param start_utc - start datetime of request at UTC
+# @ Param end_utc - end datetime of request at UTC
+#
+def split_chunk(start_utc, end_utc):
+    middle = start_utc + (end_utc - start_utc)/2
+    middle = middle.replace(minute=0, second=0, microsecond=0)
+    if middle <= start_utc:
+        middle += datetime.timedelta(hours=1)
+    if middle >= end_utc:
+        return None
+    return [(start_utc, middle), (middle, end_utc)]
@@ -0,0 +1,291 @@
+# MesoDB Station Registry
+
+# Libraries
+#
+import json
+import logging
+import os
+import os.path as osp
+import threading
+import numpy as np
+import pandas as pd
+try:
+    from .locks import *
+except:
+    from locks import *
+
+# Epoch nanoseconds bounds of the first and last seen times
+NEVER = (np.iinfo(np.int64).max, np.iinfo(np.int64).min)   # registered without observations
+UNKNOWN = (np.iinfo(np.int64).min, np.iinfo(np.int64).max) # registered before the times were tracked
+
+# Registry of the stations of the database with stable integer IDs and the first and last times each station was seen.
+# The IDs are the lines of the stations.codes file, shared with the station codes of the mmap storage engine. New
+# stations and seen times are appended to the stations.log file, compacted into the stations.pkl table when it grows.
+#
+class stationRegistry(object):
+
+    # Station registry constructor
+    #
+    # @ Param folder_path - path of the database
+    # @ Param compact_bytes - size of the log that triggers a compaction into the station table
+    #
+    def __init__(self, folder_path, compact_bytes=4*1024**2):
+        self.table_path = osp.join(folder_path, 'stations.pkl')
+        self.codes_path = osp.join(folder_path, 'stations.codes')
+        self.log_path = osp.join(folder_path, 'stations.log')
+        self.lock_path = osp.join(folder_path, '.stations.codes.lock')
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self.load()
+        self.migrate()
+
+    # Return stamp of a file, None if it does not exist
+    #
+    # @ Param path - path of the file
+    #
+    def file_stamp(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Load registry from the station table, the codes and the log
+    #
+    def load(self):
+        with self.lock:
+            self.table_stamp = self.file_stamp(self.table_path)
+            self.meta = {}
+            self.seen = {}
+            if self.table_stamp is not None:
+                table = pd.read_pickle(self.table_path)
+                stids = table.index.astype(str)
+                if 'FIRST_SEEN' in table:
+                    # NaT times are unknown
+                    first = table['FIRST_SEEN'].values.astype('datetime64[ns]').view(np.int64)
+                    last = table['LAST_SEEN'].values.astype('datetime64[ns]').view(np.int64)
+                    self.seen = {stid: UNKNOWN if t0 == UNKNOWN[0] else (int(t0),int(t1))
+                                 for stid,t0,t1 in zip(stids, first, last)}
+                table = table.drop(columns=['ID','FIRST_SEEN','LAST_SEEN'], errors='ignore')
+                self.meta = dict(zip(stids, table.to_dict('records')))
+                for stid in self.meta:
+                    self.seen.setdefault(stid, UNKNOWN)
+            self.codes_size = 0
+            self.ids = pd.Index([], dtype=object)
+            self.read_codes()
+            self.log_offset = 0
+            self.replay()
+            self.frame = None
+            self.dtype = None
+
+    # Assign IDs to the stations of a station table written before the registry
+    #
+    def migrate(self):
+        missing = [stid for stid in self.meta if stid not in self.ids]
+        if len(missing):
+            logging.info('stationRegistry.migrate - assigning IDs to {} stations'.format(len(missing)))
+            with fileLock(self.lock_path):
+                self.refresh()
+                self.assign(missing)
+
+    # Read the new lines of the station codes
+    #
+    def read_codes(self):
+        size = osp.getsize(self.codes_path) if osp.exists(self.codes_path) else 0
+        if size > self.codes_size:
+            with open(self.codes_path, 'r') as f:
+                f.seek(self.codes_size)
+                text = f.read(size - self.codes_size)
+            # a line being written by another process is read later
+            text = text[:text.rfind('\n')+1]
+            self.ids = self.ids.append(pd.Index([s for s in text.split('\n') if s != ''], dtype=object))
+            self.codes_size += len(text.encode('utf-8'))
+
+    # Apply the log entries written after the last ones applied
+    #
+    def replay(self):
+        size = osp.getsize(self.log_path) if osp.exists(self.log_path) else 0
+        if size <= self.log_offset:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.log_offset)
+            text = f.read(size - self.log_offset)
+        text = text[:text.rfind(b'\n')+1]
+        for line in text.decode('utf-8').split('\n'):
+            if line != '':
+                self.apply(json.loads(line))
+        self.log_offset += len(text)
+        self.frame = None
+
+    # Apply a log entry to the registry in memory
+    #
+    # @ Param entry - dictionary with the new stations (add) and the seen times (seen)
+    #
+    def apply(self, entry):
+        for row in entry.get('add', []):
+            stid = str(row.pop('STID'))
+            if stid not in self.meta:
+                self.meta[stid] = row
+                self.seen.setdefault(stid, NEVER)
+        for stid,(t0,t1) in entry.get('seen', {}).items():
+            first,last = self.seen.get(stid, NEVER)
+            self.seen[stid] = (min(first, t0),max(last, t1))
+
+    # Bring the registry up to date with the changes of other processes
+    #
+    def refresh(self):
+        with self.lock:
+            log_size = osp.getsize(self.log_path) if osp.exists(self.log_path) else 0
+            if self.file_stamp(self.table_path) != self.table_stamp or log_size < self.log_offset:
+                # the log was compacted
+                self.load()
+                return
+            self.read_codes()
+            self.replay()
+
+    # Append new STIDs to the station codes, the file lock has to be held
+    #
+    # @ Param stids - list of STIDs not in the codes
+    #
+    def assign(self, stids):
+        stids = [s for s in stids if s not in self.ids]
+        if len(stids):
+            with open(self.codes_path, 'a') as f:
+                f.write(''.join([s + '\n' for s in stids]))
+            self.read_codes()
+
+    # Register the new stations and the times their observations were seen
+    #
+    # @ Param sites - dataframe of stations indexed by STID
+    # @ Param data - dataframe with observations of the stations, None if there are none
+    #
+    def add(self, sites, data=None):
+        entry = {}
+        with self.lock:
+            self.refresh()
+            new_sites = sites[[stid not in self.meta for stid in sites.index.astype(str)]]
+            if len(new_sites):
+                entry['add'] = json.loads(new_sites.rename_axis('STID').reset_index().to_json(orient='records'))
+            if data is not None and len(data):
+                seen = {}
+                codes,stids = pd.factorize(data['STID'].astype(str).values)
+                times = pd.Series(data['datetime'].values.astype('datetime64[ns]').view(np.int64)).groupby(codes)
+                for stid,t0,t1 in zip(stids, times.min().values, times.max().values):
+                    first,last = self.seen.get(stid, NEVER)
+                    # only the times extending the known ones are logged
+                    if t0 < first or t1 > last:
+                        seen[stid] = [int(t0),int(t1)]
+                if len(seen):
+                    entry['seen'] = seen
+            if not len(entry):
+                return
+            with fileLock(self.lock_path):
+                # other processes could have added some of them
+                self.refresh()
+                if 'add' in entry:
+                    entry['add'] = [row for row in entry['add'] if str(row['STID']) not in self.meta]
+                    self.assign([str(row['STID']) for row in entry['add']])
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                self.replay()
+                if self.log_offset > self.compact_bytes:
+                    self.compact()
+
+    # Rewrite the station table with the log applied and empty the log, the file lock has to be held
+    #
+    def compact(self):
+        with self.lock:
+            logging.info('stationRegistry.compact - compacting {} bytes of station log'.format(self.log_offset))
+            with atomic_write(self.table_path) as tmp:
+                self.sites(seen=True).drop(columns=['ID']).to_pickle(tmp, compression=None)
+            with open(self.log_path, 'w'):
+                pass
+            self.table_stamp = self.file_stamp(self.table_path)
+            self.log_offset = 0
+
+    # Return dataframe of the stations indexed by STID with their IDs, sorted by ID
+    #
+    # @ Param seen - include FIRST_SEEN and LAST_SEEN columns, NaT if unknown
+    #
+    def sites(self, seen=False):
+        with self.lock:
+            self.refresh()
+            if self.frame is None:
+                stids = [stid for stid in self.ids if stid in self.meta]
+                frame = pd.DataFrame([self.meta[stid] for stid in stids], index=pd.Index(stids, name='STID'))
+                frame['ID'] = self.ids.get_indexer(stids).astype(np.int32)
+                times = np.array([self.seen.get(stid, UNKNOWN) for stid in stids], dtype=np.int64).reshape(-1,2)
+                # stations never seen are saved as unknown
+                unset = (times[:,0] > times[:,1]) | (times[:,0] == UNKNOWN[0])
+                for k,column in enumerate(['FIRST_SEEN','LAST_SEEN']):
+                    frame[column] = pd.to_datetime(np.where(unset, UNKNOWN[0], times[:,k]), utc=True)
+                self.frame = frame
+            if seen:
+                return self.frame.copy()
+            return self.frame.drop(columns=['FIRST_SEEN','LAST_SEEN'])
+
+    # Return stamp of the stations registered, changes when stations are added
+    #
+    def stamp(self):
+        with self.lock:
+            self.refresh()
+            return (len(self.meta),len(self.ids))
+
+    # Return categorical dtype of the STIDs whose codes are the station IDs, the same object until stations are added
+    #
+    def categories(self):
+        with self.lock:
+            self.refresh()
+            if self.dtype is None or len(self.dtype.categories) != len(self.ids):
+                self.dtype = pd.CategoricalDtype(self.ids)
+            return self.dtype
+
+    # Return station IDs of STIDs, -1 for the ones not registered
+    #
+    # @ Param stids - list of STIDs
+    #
+    def get_ids(self, stids):
+        with self.lock:
+            self.refresh()
+            return self.ids.get_indexer(np.asarray(stids, dtype=str)).astype(np.int32)
+
+    # Return STIDs of station IDs
+    #
+    # @ Param ids - array of station IDs
+    #
+    def get_stids(self, ids):
+        with self.lock:
+            self.refresh()
+            return self.ids.values[np.asarray(ids)]
+
+    # Return STIDs of the stations seen in a time interval, keeping the ones whose times are unknown
+    #
+    # @ Param start_utc - start datetime at UTC
+    # @ Param end_utc - end datetime at UTC
+    # @ Param stids - list of STIDs to select from, None selects from all of them
+    #
+    def active(self, start_utc, end_utc, stids=None):
+        with self.lock:
+            self.refresh()
+            if stids is None:
+                stids = list(self.seen)
+            t0,t1 = pd.Timestamp(start_utc).value,pd.Timestamp(end_utc).value
+            keep = []
+            for stid in stids:
+                first,last = self.seen.get(str(stid), UNKNOWN)
+                if first <= t1 and last >= t0:
+                    keep.append(stid)
+            return np.array(keep, dtype=object)
+
+    # Replace the seen times of the stations, for instance computed scanning the hour files
+    #
+    # @ Param seen - dictionary of first and last epoch nanoseconds by STID
+    #
+    def reset_seen(self, seen):
+        with fileLock(self.lock_path):
+            with self.lock:
+                self.refresh()
+                for stid in self.meta:
+                    self.seen[stid] = tuple(seen.get(stid, NEVER))
+                self.frame = None
+                self.compact()
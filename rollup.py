@@ -0,0 +1,167 @@
+# MesoDB Rollups
+
+# Libraries
+#
+import glob
+import os
+import os.path as osp
+import numpy as np
+import pandas as pd
+try:
+    from .utils import *
+    from .locks import *
+except:
+    from utils import *
+    from locks import *
+
+# Statistics kept by the rollups for each variable
+STATS = ('count', 'min', 'max', 'sum', 'last')
+
+# Return variable columns of a dataframe of observations
+#
+# @ Param data - dataframe with observations
+#
+def rollup_variables(data):
+    return [column for column in data.columns if column not in ('STID', 'datetime') and
+            pd.api.types.is_numeric_dtype(data[column])]
+
+# Compute statistics per station and period of a dataframe of observations
+#
+# @ Param data - dataframe with observations
+# @ Param freq - length of the periods (h for hourly, D for daily)
+#
+def rollup_frame(data, freq='h'):
+    variables = rollup_variables(data)
+    if not len(data):
+        return pd.DataFrame(columns=['STID','datetime'] + ['{}_{}'.format(v,s) for v in variables for s in STATS])
+    data = data.sort_values('datetime', kind='stable')
+    keys = [data['STID'].astype(str).values, data['datetime'].dt.floor(freq).values]
+    grouped = data[variables].astype(np.float64).groupby(keys, sort=True)
+    result = grouped.agg(list(STATS))
+    result.columns = ['{}_{}'.format(v,s) for v,s in result.columns]
+    result.index.names = ['STID', 'datetime']
+    result = result.reset_index()
+    result['datetime'] = pd.to_datetime(result['datetime'], utc=True)
+    return result
+
+# Combine rollups of shorter periods into rollups of longer ones
+#
+# @ Param rollups - dataframe with rollups
+# @ Param keys - columns to group by
+#
+def combine_rollups(rollups, keys):
+    rollups = rollups.sort_values('datetime', kind='stable')
+    variables = [column[:-len('_count')] for column in rollups.columns if column.endswith('_count')]
+    aggs = {}
+    for v in variables:
+        aggs.update({v+'_count': 'sum', v+'_min': 'min', v+'_max': 'max', v+'_sum': 'sum'})
+        if v+'_last' in rollups.columns:
+            aggs[v+'_last'] = 'last'
+    return rollups.groupby(keys, sort=True).agg(aggs).reset_index()
+
+# Add mean columns to a dataframe with rollups
+#
+# @ Param rollups - dataframe with rollups
+#
+def add_means(rollups):
+    for column in [column for column in rollups.columns if column.endswith('_count')]:
+        v = column[:-len('_count')]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rollups[v+'_mean'] = rollups[v+'_sum']/rollups[v+'_count'].where(rollups[v+'_count'] > 0)
+    return rollups
+
+# Hourly and daily statistics per station maintained when hour files are written, one file per julian day
+#
+class rollupStore(object):
+
+    # Rollup store constructor
+    #
+    # @ Param folder_path - path of the database
+    #
+    def __init__(self, folder_path):
+        self.folder_path = osp.join(folder_path, 'rollups')
+
+    # Return path of the rollups of the day of a datetime
+    #
+    # @ Param utc_datetime - UTC datetime object
+    #
+    def day_path(self, utc_datetime):
+        return osp.join(self.folder_path, '{:04d}'.format(utc_datetime.year),
+                        '{:03d}.pkl'.format(utc_datetime.timetuple().tm_yday))
+
+    # Load hourly and daily rollups of the day of a datetime, None if there are no rollups
+    #
+    # @ Param utc_datetime - UTC datetime object
+    #
+    def load(self, utc_datetime):
+        path = self.day_path(utc_datetime)
+        if osp.exists(path):
+            return pd.read_pickle(path)
+        return None
+
+    # Replace the rollups of written hours with the statistics of their observations
+    #
+    # @ Param data - dataframe with observations
+    # @ Param hours - list of UTC datetimes of the hours written, hours without observations are cleared
+    #
+    def update(self, data, hours):
+        hourly = rollup_frame(data, 'h')
+        hours = pd.to_datetime(pd.Series(hours), utc=True).dt.floor('h')
+        for day,day_hours in hours.groupby(hours.dt.floor('D')):
+            path = ensure_dir(self.day_path(day))
+            with fileLock(path + '.lock'):
+                self.update_day(day, day_hours, hourly)
+
+    # Replace the rollups of written hours of a day, the lock of the day has to be held
+    #
+    # @ Param day - UTC datetime of the day
+    # @ Param day_hours - UTC datetimes of the hours written in the day
+    # @ Param hourly - hourly rollups of the observations written
+    #
+    def update_day(self, day, day_hours, hourly):
+        path = self.day_path(day)
+        rollups = self.load(day)
+        day_rows = hourly[hourly['datetime'].isin(day_hours)]
+        if rollups is not None:
+            # finalized hours replace the rows of their realtime versions
+            old = rollups['hourly']
+            day_rows = pd.concat([old[~old['datetime'].isin(day_hours)], day_rows], ignore_index=True)
+        day_rows = day_rows.sort_values(['datetime','STID'], kind='stable').reset_index(drop=True)
+        if not len(day_rows):
+            if rollups is not None:
+                os.remove(path)
+            return
+        daily = combine_rollups(day_rows.assign(datetime=day), ['STID','datetime'])
+        with atomic_write(path) as tmp:
+            pd.to_pickle({'hourly': day_rows, 'daily': daily}, tmp, compression=None)
+
+    # Return rollups of the periods starting in a time interval
+    #
+    # @ Param start_utc - start datetime at UTC
+    # @ Param end_utc - end datetime at UTC
+    # @ Param freq - hourly (h) or daily (D) rollups
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    #
+    def query(self, start_utc, end_utc, freq='D', stids=None):
+        table = 'daily' if freq.upper() == 'D' else 'hourly'
+        start = pd.Timestamp(start_utc).floor('D' if table == 'daily' else 'h')
+        end = pd.Timestamp(end_utc)
+        data = []
+        for day in pd.date_range(start.floor('D'), end.floor('D'), freq='D'):
+            rollups = self.load(day)
+            if rollups is None:
+                continue
+            rows = rollups[table]
+            rows = rows[rows['datetime'].between(start, end)]
+            if stids is not None:
+                rows = rows[rows['STID'].isin(stids)]
+            data.append(rows)
+        if not len(data):
+            return pd.DataFrame([])
+        return pd.concat(data, ignore_index=True)
+
+    # Remove all the rollups
+    #
+    def clear(self):
+        for path in glob.glob(osp.join(self.folder_path,'[0-9]'*4,'[0-9]'*3 + '.pkl')):
+            os.remove(path)
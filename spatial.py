@@ -0,0 +1,169 @@
+# MesoDB Station Spatial Index
+
+# Libraries
+#
+import logging
+import os.path as osp
+import pickle
+import numpy as np
+import pandas as pd
+try:
+    from .locks import *
+except:
+    from locks import *
+
+# Earth radius in km
+EARTH_RADIUS = 6371.0
+
+# Return great circle distances in km from a point to arrays of coordinates
+#
+# @ Param lat,lon - coordinates of the point in WGS84 degrees
+# @ Param lats,lons - arrays of coordinates in WGS84 degrees
+#
+def haversine(lat, lon, lats, lons):
+    lat,lon,lats,lons = map(np.radians, (lat, lon, lats, lons))
+    a = np.sin((lats-lat)/2.)**2 + np.cos(lat)*np.cos(lats)*np.sin((lons-lon)/2.)**2
+    return 2.*EARTH_RADIUS*np.arcsin(np.sqrt(a))
+
+# Grid spatial index over the station table for bounding box, radius and nearest stations queries
+#
+class stationIndex(object):
+
+    # Station index constructor
+    #
+    # @ Param sites - dataframe of stations indexed by STID with LATITUDE, LONGITUDE and STATE
+    # @ Param cell - size of the grid cells in degrees
+    #
+    def __init__(self, sites, cell=1.):
+        self.cell = cell
+        self.stids = np.array(sites.index.values, dtype=object)
+        if len(sites):
+            self.lats = pd.to_numeric(sites['LATITUDE'], errors='coerce').values.astype(float)
+            self.lons = pd.to_numeric(sites['LONGITUDE'], errors='coerce').values.astype(float)
+            states = sites['STATE'].fillna('').astype(str).str.lower().values
+        else:
+            self.lats = self.lons = np.array([], dtype=float)
+            states = np.array([], dtype=object)
+        # stations by state
+        self.states = {state: np.flatnonzero(states == state) for state in np.unique(states)}
+        self.state_order = np.lexsort((self.stids.astype(str), states.astype(str)))
+        # stations by grid cell, sorted by cell so each cell is a contiguous range of positions
+        valid = np.flatnonzero(np.isfinite(self.lats) & np.isfinite(self.lons))
+        rows = np.floor(self.lats[valid]/cell).astype(np.int64)
+        cols = np.floor(self.lons[valid]/cell).astype(np.int64)
+        order = np.lexsort((cols, rows))
+        self.order = valid[order]
+        keys,starts = np.unique(np.stack((rows[order], cols[order]), axis=1), axis=0, return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.cells = {(r,c): (s,e) for (r,c),s,e in zip(keys.tolist(), starts.tolist(), ends.tolist())}
+
+    # Return number of stations in the index
+    #
+    def __len__(self):
+        return len(self.stids)
+
+    # Return positions of the stations in the grid cells intersecting a bounding box
+    #
+    # @ Param lat1,lat2,lon1,lon2 - bounding box in WGS84 degrees
+    #
+    def candidates(self, lat1, lat2, lon1, lon2):
+        rows = range(int(np.floor(lat1/self.cell)), int(np.floor(lat2/self.cell))+1)
+        cols = range(int(np.floor(lon1/self.cell)), int(np.floor(lon2/self.cell))+1)
+        ranges = [self.cells[(r,c)] for r in rows for c in cols if (r,c) in self.cells]
+        if not len(ranges):
+            return np.array([], dtype=np.int64)
+        return np.concatenate([self.order[s:e] for s,e in ranges])
+
+    # Return STIDs of the stations inside a bounding box
+    #
+    # @ Param lat1,lat2,lon1,lon2 - bounding box in WGS84 degrees
+    #
+    def bbox(self, lat1, lat2, lon1, lon2):
+        pos = self.candidates(lat1, lat2, lon1, lon2)
+        inside = (self.lats[pos] >= lat1) & (self.lats[pos] <= lat2) & (self.lons[pos] >= lon1) & (self.lons[pos] <= lon2)
+        return self.stids[np.sort(pos[inside])]
+
+    # Return positions and distances of the stations within a radius of a point
+    #
+    # @ Param lat,lon - coordinates of the point in WGS84 degrees
+    # @ Param radius - radius in km
+    #
+    def within(self, lat, lon, radius):
+        dlat = np.degrees(radius/EARTH_RADIUS)
+        dlon = dlat/max(np.cos(np.radians(min(abs(lat)+dlat, 89.9))), 1e-6)
+        pos = self.candidates(lat-dlat, lat+dlat, lon-dlon, lon+dlon)
+        dist = haversine(lat, lon, self.lats[pos], self.lons[pos])
+        inside = dist <= radius
+        return pos[inside],dist[inside]
+
+    # Return STIDs of the stations within a radius of a point
+    #
+    # @ Param lat,lon - coordinates of the point in WGS84 degrees
+    # @ Param radius - radius in km
+    #
+    def radius(self, lat, lon, radius):
+        pos,_ = self.within(lat, lon, radius)
+        return self.stids[np.sort(pos)]
+
+    # Return STIDs and distances in km of the n nearest stations to a point, sorted by distance
+    #
+    # @ Param lat,lon - coordinates of the point in WGS84 degrees
+    # @ Param n - number of stations
+    #
+    def nearest(self, lat, lon, n):
+        n = min(n, len(self.order))
+        if n <= 0:
+            return self.stids[:0],np.array([])
+        # grow a square of cells around the point until it has enough stations
+        k = 0
+        while True:
+            pos = self.candidates(lat-k*self.cell, lat+k*self.cell, lon-k*self.cell, lon+k*self.cell)
+            if len(pos) >= n or k*self.cell >= 360.:
+                break
+            k += 1
+        # the n-th distance bounds the search radius, stations outside the square may be closer
+        dist = haversine(lat, lon, self.lats[pos], self.lons[pos])
+        pos,dist = self.within(lat, lon, np.partition(dist, n-1)[n-1])
+        order = np.argsort(dist, kind='stable')[:n]
+        return self.stids[pos[order]],dist[order]
+
+    # Return STIDs of all the stations grouped by state and sorted by STID inside each state
+    #
+    def ordering(self):
+        return self.stids[self.state_order]
+
+    # Return STIDs of the stations in a state
+    #
+    # @ Param state - state code (not case sensitive)
+    #
+    def state(self, state):
+        return self.stids[self.states.get(state.lower(), np.array([], dtype=np.int64))]
+
+    # Save index to disk
+    #
+    # @ Param path - path of the index file
+    # @ Param stamp - stamp of the station table the index was built from
+    #
+    def save(self, path, stamp):
+        self.stamp = stamp
+        with atomic_write(path) as tmp:
+            with open(tmp, 'wb') as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Load index from disk, None if it does not exist or it was built from another station table
+    #
+    # @ Param path - path of the index file
+    # @ Param stamp - stamp of the current station table
+    #
+    @staticmethod
+    def load(path, stamp):
+        if osp.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    index = pickle.load(f)
+                if getattr(index, 'stamp', None) == stamp:
+                    return index
+            except Exception as e:
+                logging.warning('stationIndex.load - could not load {}: {}'.format(path, e))
+        return None
+
@@ -0,0 +1,998 @@
+# MesoDB Storage Engines
+
+# Libraries
+#
+import glob
+import json
+import logging
+import os.path as osp
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from .utils import *
+    from .locks import *
+except:
+    from utils import *
+    from locks import *
+
+# Cost of a step of the binary search of the station groups per group, relative to comparing the time of one row
+SEARCH_COST = 16
+
+# Return maximum number of memory maps kept open, well below the limit of open files of the process since each
+# memory map holds a file descriptor
+#
+# @ Param default - maximum number if the limit is unknown or large
+#
+def map_limit(default=256):
+    if resource is None:
+        return default
+    soft,_ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return default
+    return max(16, min(default, soft//4))
+
+# Storage Engine Error
+#
+class storageError(Exception):
+    pass
+
+# Sort observations grouping the rows of each station together
+#
+# @ Param data - dataframe with observations
+# @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+#
+def sort_observations(data, order=None):
+    stids = data['STID'].astype(str).values
+    if order is not None and len(order):
+        rank = pd.Categorical(stids, categories=pd.unique(np.asarray(order, dtype=str))).codes.astype(np.int64)
+        rank[rank < 0] = len(order)
+    else:
+        rank = np.zeros(len(stids), dtype=np.int64)
+    data = data.iloc[np.lexsort((data['datetime'].values, stids, rank))].reset_index(drop=True)
+    # filtering the rows keeps them sorted, so the flag is kept by the frames read from the file
+    data.attrs['time_sorted'] = True
+    return data
+
+# Return the row range of each station in sorted observations
+#
+# @ Param data - dataframe with observations sorted by station groups
+#
+def station_offsets(data):
+    stids = data['STID'].astype(str).values
+    starts = np.flatnonzero(np.r_[True, stids[1:] != stids[:-1]]) if len(stids) else np.array([], dtype=np.int64)
+    ends = np.append(starts[1:], len(stids))
+    return {stids[s]: [int(s), int(e)] for s,e in zip(starts, ends)}
+
+# Return start positions of the station groups of observations grouped by station
+#
+# @ Param stids - array or series of STIDs or station codes
+#
+def group_starts(stids):
+    values = stids.cat.codes.values if isinstance(getattr(stids, 'dtype', None), pd.CategoricalDtype) else np.asarray(stids)
+    if not len(values):
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+
+# Return first position of each station group with time not before (left) or after (right) a time, searching all
+# the groups at once by bisection
+#
+# @ Param times - array of epoch nanoseconds sorted inside each station group
+# @ Param starts - start positions of the station groups
+# @ Param ends - end positions of the station groups
+# @ Param t - epoch nanoseconds searched
+# @ Param side - left or right like numpy.searchsorted
+#
+def search_groups(times, starts, ends, t, side='left'):
+    lo,hi = starts.copy(),ends.copy()
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi)//2
+        values = times[np.where(active, mid, 0)]
+        right = active & ((values < t) if side == 'left' else (values <= t))
+        lo = np.where(right, mid+1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo
+
+# Return method of time_slice for observations sorted by time inside each station group: search if the steps of
+# the binary search of all the groups cost less than comparing all the rows, else mask. The search only pays off for
+# groups of hundreds of rows, hour files of stations reporting every few minutes or less often are compared.
+#
+# @ Param n - number of rows
+# @ Param starts - start positions of the station groups
+#
+def slice_method(n, starts):
+    if not len(starts):
+        return 'mask'
+    steps = int(np.ceil(np.log2(np.diff(starts, append=n).max() + 1)))
+    # two searches (start and end of the interval) of all the groups
+    return 'search' if 2*SEARCH_COST*steps*len(starts) < n else 'mask'
+
+# Return positions of the rows inside a time interval of observations sorted by time inside each station group,
+# or None if all the rows are inside
+#
+# @ Param times - array of epoch nanoseconds sorted inside each station group
+# @ Param starts - start positions of the station groups
+# @ Param t0,t1 - time interval in epoch nanoseconds
+# @ Param method - search (binary search of the groups), mask (compare all the rows) or None to choose by slice_method
+#
+def time_slice(times, starts, t0, t1, method=None):
+    if not len(times):
+        return None
+    if (method or slice_method(len(times), starts)) == 'mask':
+        mask = (times >= t0) & (times <= t1)
+        return None if mask.all() else np.flatnonzero(mask)
+    ends = np.append(starts[1:], len(times))
+    lo = search_groups(times, starts, ends, t0, 'left')
+    hi = search_groups(times, starts, ends, t1, 'right')
+    counts = hi - lo
+    if counts.sum() == len(times):
+        return None
+    # concatenate the ranges of the groups
+    return np.arange(counts.sum()) + np.repeat(lo - np.cumsum(counts) + counts, counts)
+
+# Return rows of observations inside a time interval, slicing the station groups of observations sorted by time
+# inside each of them by binary search
+#
+# @ Param data - dataframe of observations
+# @ Param bounds - time interval in epoch nanoseconds
+#
+def trim_observations(data, bounds):
+    times = data['datetime'].values.astype('datetime64[ns]').view(np.int64)
+    if data.attrs.get('time_sorted'):
+        rows = time_slice(times, group_starts(data['STID']), *bounds)
+    else:
+        # hour files written before they were sorted
+        mask = (times >= bounds[0]) & (times <= bounds[1])
+        rows = None if mask.all() else np.flatnonzero(mask)
+    return data if rows is None else data.iloc[rows]
+
+# Return the observations not saved yet, comparing station and time with the saved ones
+#
+# @ Param stids - array of STIDs of the saved observations
+# @ Param times - array of epoch nanoseconds of the saved observations
+# @ Param data - dataframe with new observations
+#
+def new_observations(stids, times, data):
+    if not len(stids) or not len(data):
+        return data
+    saved = pd.MultiIndex.from_arrays([np.asarray(stids, dtype=str), np.asarray(times, dtype=np.int64)])
+    keys = pd.MultiIndex.from_arrays([data['STID'].astype(str).values,
+                                      data['datetime'].values.astype('datetime64[ns]').view(np.int64)])
+    return data[~keys.isin(saved)]
+
+# Pickle storage engine, one pandas pickle per hour (legacy format). The hour files are written to a temporary
+# file renamed over the final one, and the changes of each day are serialized by a file lock of its folder.
+#
+class pickleStorage(object):
+    name = 'pickle'
+    ext = 'pkl'
+
+    # Return file lock of the day folder of an hour file
+    #
+    # @ Param path - path of the hour file
+    #
+    def day_lock(self, path):
+        return fileLock(osp.join(osp.dirname(path), '.lock'))
+
+    # Write an hour of observations
+    #
+    # @ Param data - dataframe with the observations of the hour
+    # @ Param path - path of the hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def write(self, data, path, order=None):
+        ensure_dir(path)
+        with self.day_lock(path):
+            self.save_hour(data, path, order)
+
+    # Write an hour of observations atomically recording its checksum, the day lock has to be held
+    #
+    # @ Param data - dataframe with the observations of the hour
+    # @ Param path - path of the hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def save_hour(self, data, path, order=None):
+        with atomic_write(path) as tmp:
+            self.write_file(data, tmp, order)
+        self.set_checksum(path, file_checksum(path))
+
+    # Write an hour of observations to a file
+    #
+    # @ Param data - dataframe with the observations of the hour
+    # @ Param path - path of the file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def write_file(self, data, path, order=None):
+        compact_observations(sort_observations(data, order)).to_pickle(path, compression=None)
+
+    # Read an hour of observations
+    #
+    # @ Param path - path of the hour file
+    # @ Param columns - list of columns to read, None reads all of them
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    #
+    def read(self, path, columns=None, stids=None):
+        data = pd.read_pickle(path)
+        if stids is not None:
+            data = data[data['STID'].isin(stids)]
+        if columns is not None:
+            data = data[[c for c in columns if c in data]]
+        return data
+
+    # Return stamp of an hour file that changes when it is rewritten, None if it does not exist
+    #
+    # @ Param path - path of the hour file
+    #
+    def stamp(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Checks if hour file exists, if so returns true, else false
+    #
+    # @ Param path - path of the hour file
+    #
+    def exists(self, path):
+        return osp.exists(path)
+
+    # Remove an hour file
+    #
+    # @ Param path - path of the hour file
+    #
+    def remove(self, path):
+        if osp.exists(osp.dirname(path)):
+            with self.day_lock(path):
+                self.remove_file(path)
+
+    # Remove an hour file and its checksum, the day lock has to be held
+    #
+    # @ Param path - path of the hour file
+    #
+    def remove_file(self, path):
+        if osp.exists(path):
+            os.remove(path)
+            self.set_checksum(path, None)
+
+    # Append observations to an hour skipping the ones already saved, returns the number of observations appended
+    #
+    # @ Param data - dataframe with new observations of the hour
+    # @ Param path - path of the hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def append_hour(self, data, path, order=None):
+        ensure_dir(path)
+        with self.day_lock(path):
+            return self.append_file(data, path, order)
+
+    # Append observations to an hour, the day lock has to be held
+    #
+    # @ Param data - dataframe with new observations of the hour
+    # @ Param path - path of the hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def append_file(self, data, path, order=None):
+        if not self.exists(path):
+            self.save_hour(data, path, order)
+            return len(data)
+        old = self.read(path)
+        data = new_observations(old['STID'].values, old['datetime'].values.astype('datetime64[ns]').view(np.int64), data)
+        if len(data):
+            # files of a single frame, they have to be rewritten
+            self.save_hour(pd.concat([old.astype({'STID': str}), data.astype({'STID': str})], ignore_index=True), path, order)
+        return len(data)
+
+    # Replace a realtime hour by its final hour file
+    #
+    # @ Param tmp_path - path of the realtime hour file
+    # @ Param path - path of the final hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def finalize(self, tmp_path, path, order=None):
+        with self.day_lock(path):
+            self.save_hour(self.read(tmp_path), path, order)
+            self.remove_file(tmp_path)
+
+    # Load checksums of the hour files of a day
+    #
+    # @ Param day_path - path of the julian day folder
+    #
+    def load_checksums(self, day_path):
+        path = osp.join(day_path, 'checksums.json')
+        if osp.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return {}
+
+    # Record checksum of an hour file, the day lock has to be held
+    #
+    # @ Param path - path of the hour file
+    # @ Param checksum - CRC32 of the file, None removes it
+    #
+    def set_checksum(self, path, checksum):
+        day_path = osp.dirname(path)
+        checksums = self.load_checksums(day_path)
+        if checksum is None:
+            checksums.pop(osp.basename(path), None)
+        else:
+            checksums[osp.basename(path)] = checksum
+        with atomic_write(osp.join(day_path, 'checksums.json')) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(checksums, f, sort_keys=True)
+
+    # Checks if an hour file is valid comparing it with its checksum, or reading it if it has no checksum
+    #
+    # @ Param path - path of the hour file
+    #
+    def verify(self, path):
+        if not self.exists(path):
+            return False
+        checksum = self.load_checksums(osp.dirname(path)).get(osp.basename(path))
+        if checksum is not None:
+            return file_checksum(path) == checksum
+        try:
+            self.read(path)
+            return True
+        except Exception:
+            return False
+
+    # Return paths of all the hour files of a database
+    #
+    # @ Param folder_path - path of the database
+    #
+    def list_hours(self, folder_path):
+        pattern = osp.join(folder_path,'[0-9]'*4,'[0-9]'*3,'[0-9]'*9 + '.' + self.ext)
+        return glob.glob(pattern) + glob.glob(pattern + '_tmp')
+
+# Parquet storage engine, one compressed columnar file per hour partitioned in year/jday folders
+#
+class parquetStorage(pickleStorage):
+    name = 'parquet'
+    ext = 'parquet'
+
+    # Parquet storage constructor
+    #
+    # @ Param compression - parquet compression codec
+    # @ Param row_group_size - maximum number of rows per row group
+    #
+    def __init__(self, compression='zstd', row_group_size=2048):
+        if pq is None:
+            raise storageError('parquetStorage - pyarrow is required for the parquet storage engine.')
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+    # Cast observations to the typed on-disk schema grouping the rows of each station together
+    #
+    # @ Param data - dataframe with observations
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def typed(self, data, order=None):
+        return compact_observations(sort_observations(data, order))
+
+    # Write an hour of observations to a file with the row range of each station in the file metadata
+    #
+    # @ Param data - dataframe with the observations of the hour
+    # @ Param path - path of the file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def write_file(self, data, path, order=None):
+        data = self.typed(data, order)
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'mesodb.offsets'] = json.dumps(station_offsets(data)).encode()
+        table = table.replace_schema_metadata(metadata)
+        pq.write_table(table, path, compression=self.compression, row_group_size=self.row_group_size)
+
+    # Read an hour of observations, only reading the columns and row groups needed
+    #
+    # @ Param path - path of the hour file
+    # @ Param columns - list of columns to read, None reads all of them
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    #
+    def read(self, path, columns=None, stids=None):
+        if columns is not None:
+            # variables not stored in the file are not returned
+            names = pq.read_schema(path).names
+            columns = [c for c in columns if c in names]
+        if stids is None:
+            table = pq.read_table(path, columns=columns)
+            return self.frame(table, b'mesodb.offsets' in (table.schema.metadata or {}))
+        pf = pq.ParquetFile(path)
+        metadata = pf.schema_arrow.metadata or {}
+        if b'mesodb.offsets' not in metadata:
+            # files without offsets, filter using row group statistics
+            if columns is not None and 'STID' not in columns:
+                columns = ['STID'] + list(columns)
+            return pq.read_table(path, columns=columns, filters=[('STID', 'in', [str(s) for s in stids])]).to_pandas()
+        offsets = json.loads(metadata[b'mesodb.offsets'])
+        ranges = sorted([offsets[s] for s in set([str(s) for s in stids]) if s in offsets])
+        if not len(ranges):
+            return self.frame(pf.schema_arrow.empty_table().select(columns or pf.schema_arrow.names), True)
+        # merge contiguous station ranges
+        merged = [list(ranges[0])]
+        for start,end in ranges[1:]:
+            if start == merged[-1][1]:
+                merged[-1][1] = end
+            else:
+                merged.append([start,end])
+        # read only the row groups intersecting the ranges
+        bounds = np.cumsum([0] + [pf.metadata.row_group(g).num_rows for g in range(pf.num_row_groups)])
+        groups = sorted(set([g for start,end in merged for g in range(np.searchsorted(bounds, start, 'right')-1, np.searchsorted(bounds, end-1, 'right'))]))
+        table = pf.read_row_groups(groups, columns=columns)
+        # local position of the first row of each group read
+        local = dict(zip(groups, np.cumsum([0] + [bounds[g+1]-bounds[g] for g in groups[:-1]])))
+        rows = []
+        for start,end in merged:
+            g = np.searchsorted(bounds, start, 'right')-1
+            first = local[g] + start - bounds[g]
+            rows.append(np.arange(first, first + end - start))
+        return self.frame(table.take(np.concatenate(rows)), True)
+
+    # Return dataframe of a table read from an hour file
+    #
+    # @ Param table - pyarrow table
+    # @ Param time_sorted - the file has station offsets, so it was written sorted by time inside each station group
+    #
+    def frame(self, table, time_sorted):
+        data = table.to_pandas()
+        if time_sorted:
+            data.attrs['time_sorted'] = True
+        return data
+
+# Memory-mapped storage engine, append-only fixed-width column files per julian day. Each day folder has
+# the columns time (int64 epoch nanoseconds), stid (int32 station code) and one float32 file per variable,
+# and an index with the row range (segment) of each hour. Rewritten hours are appended as new segments and
+# the days are compacted when most of their rows are not used anymore.
+#
+class mmapStorage(pickleStorage):
+    name = 'mmap'
+    ext = 'mmap'
+    zero_copy = True
+    # Seconds the column files of a compacted generation are kept for the readers that loaded its index
+    retire_seconds = 600
+
+    # Memory-mapped storage constructor
+    #
+    def __init__(self):
+        self.tables = {}
+        self.maps = OrderedDict()
+        self.max_maps = map_limit()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    # Return day folder and segment key of an hour path
+    #
+    # @ Param path - path of the hour file
+    #
+    def segment(self, path):
+        name = osp.basename(path)
+        return osp.dirname(path), name[7:9] + ('_tmp' if name.endswith('_tmp') else '')
+
+    # Return path of a column file of a day
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param index - index of the day
+    # @ Param column - column name
+    #
+    def column_path(self, day_path, index, column):
+        suffix = {'time': 'i8', 'stid': 'i4'}.get(column, 'f4')
+        return osp.join(day_path, '{}.{}.{}'.format(column, index['generation'], suffix))
+
+    # Return dtype of a column
+    #
+    # @ Param column - column name
+    #
+    def column_dtype(self, column):
+        return {'time': np.int64, 'stid': np.int32}.get(column, np.float32)
+
+    # Load index of a day
+    #
+    # @ Param day_path - path of the julian day folder
+    #
+    def load_index(self, day_path):
+        path = osp.join(day_path, 'index.json')
+        if osp.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return {'generation': 0, 'rows': 0, 'columns': [], 'segments': {}}
+
+    # Save index of a day replacing it atomically
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param index - index of the day
+    #
+    def save_index(self, day_path, index):
+        with atomic_write(osp.join(day_path, 'index.json')) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+
+    # Return station table (list of STIDs by code) of the database of a day folder
+    #
+    # @ Param day_path - path of the julian day folder
+    #
+    def station_table(self, day_path):
+        root = osp.dirname(osp.dirname(day_path))
+        path = osp.join(root, 'stations.codes')
+        size = osp.getsize(path) if osp.exists(path) else 0
+        table = self.tables.get(root)
+        if table is None or table[0] != size:
+            stids = []
+            if size:
+                with open(path, 'r') as f:
+                    stids = [s for s in f.read().split('\n') if s != '']
+            table = self.tables[root] = (size, pd.Index(stids))
+        return table[1]
+
+    # Return station codes of STIDs, appending the new STIDs to the station table
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param stids - array of STIDs
+    #
+    def encode(self, day_path, stids):
+        stids = np.asarray(stids, dtype=str)
+        table = self.station_table(day_path)
+        new = [s for s in pd.unique(stids) if s not in table]
+        if len(new):
+            root = osp.dirname(osp.dirname(day_path))
+            with fileLock(osp.join(root, '.stations.codes.lock')):
+                # other processes could have added some of them
+                table = self.station_table(day_path)
+                new = [s for s in new if s not in table]
+                with open(osp.join(root, 'stations.codes'), 'a') as f:
+                    f.write(''.join([s + '\n' for s in new]))
+            table = self.station_table(day_path)
+        return table.get_indexer(stids).astype(np.int32)
+
+    # Return memory map of a column file, keeping the last max_maps used open
+    #
+    # @ Param path - path of the column file
+    # @ Param dtype - dtype of the column
+    #
+    def memmap(self, path, dtype):
+        size = osp.getsize(path)
+        with self.lock:
+            entry = self.maps.get(path)
+            if entry is None or entry[0] != size:
+                data = np.memmap(path, dtype=dtype, mode='r') if size else np.array([], dtype=dtype)
+                entry = self.maps[path] = (size, data)
+            self.maps.move_to_end(path)
+            # the file descriptor of a memory map is closed when no view of it is left
+            while len(self.maps) > self.max_maps:
+                self.maps.popitem(last=False)
+        return entry[1]
+
+    # Drop the memory maps of the column files of the generations of a day older than a generation
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param generation - current generation of the day
+    #
+    def forget(self, day_path, generation):
+        with self.lock:
+            for path in list(self.maps):
+                if osp.dirname(path) == day_path and int(osp.basename(path).split('.')[-2]) < generation:
+                    del self.maps[path]
+            self.generations[day_path] = generation
+
+    # Append rows to the column files of a day at the end of the rows of the index
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param index - index of the day
+    # @ Param arrays - dictionary of column arrays with the same length
+    #
+    def append(self, day_path, index, arrays):
+        for column,values in arrays.items():
+            path = self.column_path(day_path, index, column)
+            dtype = self.column_dtype(column)
+            with open(path, 'r+b' if osp.exists(path) else 'wb') as f:
+                f.seek(index['rows']*np.dtype(dtype).itemsize)
+                f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+                f.truncate()
+
+    # Write an hour of observations appending a new segment to the day, the day lock has to be held
+    #
+    # @ Param data - dataframe with the observations of the hour
+    # @ Param path - path of the hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def save_hour(self, data, path, order=None):
+        day_path,key = self.segment(path)
+        data = sort_observations(data, order)
+        index = self.load_index(day_path)
+        columns = [c for c in data.columns if c not in ('STID','datetime')]
+        # new variables are filled with NaN in the rows already written
+        for column in columns:
+            if column not in index['columns']:
+                rows = index['rows']
+                index['rows'] = 0
+                self.append(day_path, index, {column: np.full(rows, np.nan)})
+                index['rows'] = rows
+                index['columns'].append(column)
+        arrays = {'time': data['datetime'].values.astype('datetime64[ns]').view(np.int64),
+                  'stid': self.encode(day_path, data['STID'].astype(str).values)}
+        for column in index['columns']:
+            arrays[column] = pd.to_numeric(data[column], errors='coerce').values if column in data else np.full(len(data), np.nan)
+        self.append(day_path, index, arrays)
+        index['segments'][key] = [index['rows'], len(data)]
+        index['rows'] += len(data)
+        index.setdefault('checksums', {})[key] = self.segment_checksum(arrays, index['columns'])
+        if key in index.get('unsorted', []):
+            index['unsorted'].remove(key)
+        self.save_index(day_path, index)
+        self.compact(day_path, index)
+
+    # Return column arrays of a segment as views of the memory-mapped day files
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param index - index of the day
+    # @ Param key - segment key
+    #
+    def segment_arrays(self, day_path, index, key):
+        offset,count = index['segments'][key]
+        return {column: self.memmap(self.column_path(day_path, index, column), self.column_dtype(column))[offset:offset+count]
+                for column in ['time','stid'] + index['columns']}
+
+    # Return CRC32 checksum of the rows of a segment and the number of variables included
+    #
+    # @ Param arrays - dictionary of column arrays of the segment
+    # @ Param columns - variables of the day
+    #
+    def segment_checksum(self, arrays, columns):
+        crc = 0
+        for column in ['time','stid'] + columns:
+            crc = zlib.crc32(np.ascontiguousarray(arrays[column], dtype=self.column_dtype(column)).tobytes(), crc)
+        return [crc, len(columns)]
+
+    # Checks if an hour segment is valid comparing it with its checksum
+    #
+    # @ Param path - path of the hour file
+    #
+    def verify(self, path):
+        day_path,key = self.segment(path)
+        try:
+            index = self.load_index(day_path)
+            if key not in index['segments']:
+                return False
+            arrays = self.read_arrays(path)
+            if len(arrays['time']) != index['segments'][key][1]:
+                return False
+            checksum = index.get('checksums', {}).get(key)
+            if checksum is None:
+                return True
+            # variables added after the segment was written are not included
+            return self.segment_checksum(arrays, index['columns'][:checksum[1]]) == checksum
+        except Exception:
+            return False
+
+    # Rewrite the column files of a day with only the rows of its current segments when most rows are unused
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param index - index of the day
+    # @ Param force - compact even if most rows are used
+    #
+    def compact(self, day_path, index, force=False):
+        if self.purge(day_path, index):
+            self.save_index(day_path, index)
+        live = sum([count for _,count in index['segments'].values()])
+        if not force and 2*live >= index['rows']:
+            return
+        logging.debug('mmapStorage.compact - compacting {} from {} to {} rows'.format(day_path, index['rows'], live))
+        new = dict(index, generation=index['generation']+1, rows=0, segments={})
+        for key,(offset,count) in sorted(index['segments'].items()):
+            arrays = self.segment_arrays(day_path, index, key)
+            self.append(day_path, new, arrays)
+            new['segments'][key] = [new['rows'], count]
+            new['rows'] += count
+        # readers of other processes could have loaded the old index, its files are removed by a later compaction
+        new['retired'] = index.get('retired', []) + [[index['generation'], time.time(), index['columns']]]
+        self.save_index(day_path, new)
+        self.forget(day_path, new['generation'])
+
+    # Remove the column files of the generations of a day retired longer than the grace period, the day lock has to be held.
+    # Returns true if any generation was removed from the index.
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param index - index of the day
+    # @ Param grace - seconds the files of a retired generation are kept, None uses retire_seconds
+    #
+    def purge(self, day_path, index, grace=None):
+        grace = self.retire_seconds if grace is None else grace
+        retired = index.get('retired', [])
+        expired = [entry for entry in retired if time.time() - entry[1] >= grace]
+        for generation,_,columns in expired:
+            for column in ['time','stid'] + columns:
+                path = self.column_path(day_path, {'generation': generation}, column)
+                if osp.exists(path):
+                    os.remove(path)
+        index['retired'] = [entry for entry in retired if entry not in expired]
+        return len(expired) > 0
+
+    # Read an hour of observations as column arrays that are views of the memory-mapped day files
+    #
+    # @ Param path - path of the hour file
+    # @ Param columns - list of variables to read, None reads all of them
+    #
+    def read_arrays(self, path, columns=None):
+        day_path,key = self.segment(path)
+        for attempt in range(2):
+            index = self.load_index(day_path)
+            if self.generations.get(day_path) != index['generation']:
+                self.forget(day_path, index['generation'])
+            offset,count = index['segments'][key]
+            try:
+                arrays = {}
+                for column in ['time','stid'] + [c for c in index['columns'] if columns is None or c in columns]:
+                    arrays[column] = self.memmap(self.column_path(day_path, index, column), self.column_dtype(column))[offset:offset+count]
+                return arrays
+            except FileNotFoundError:
+                # the day was compacted by another process after loading its index
+                if attempt:
+                    raise
+                logging.debug('mmapStorage.read_arrays - {} was compacted, reloading its index'.format(day_path))
+
+    # Read an hour of observations, the columns are views of the memory-mapped day files if no stations are filtered
+    #
+    # @ Param path - path of the hour file
+    # @ Param columns - list of columns to read, None reads all of them
+    # @ Param stids - list of station IDs to keep, None keeps all of them
+    #
+    def read(self, path, columns=None, stids=None):
+        day_path,_ = self.segment(path)
+        arrays = self.read_arrays(path, columns)
+        table = self.station_table(day_path)
+        if stids is not None:
+            mask = np.isin(arrays['stid'], self.codes(day_path, stids))
+            arrays = {column: values[mask] for column,values in arrays.items()}
+        data = arrays_2_df(arrays, table)
+        if columns is not None:
+            data = data[[c for c in columns if c in data]]
+        return data
+
+    # Checks if the rows of an hour segment are sorted by time inside each station group, segments with rows
+    # appended in place are not
+    #
+    # @ Param path - path of the hour file
+    #
+    def time_sorted(self, path):
+        day_path,key = self.segment(path)
+        return key not in self.load_index(day_path).get('unsorted', [])
+
+    # Return station codes of existing STIDs
+    #
+    # @ Param day_path - path of the julian day folder
+    # @ Param stids - list of STIDs
+    #
+    def codes(self, day_path, stids):
+        codes = self.station_table(day_path).get_indexer(np.asarray(stids, dtype=str))
+        return codes[codes >= 0].astype(np.int32)
+
+    # Return stamp of an hour segment, the stamp of the index of its day, which is replaced on every change of the day
+    # (new, appended, removed or compacted segments). None if the day does not exist.
+    #
+    # @ Param path - path of the hour file
+    #
+    def stamp(self, path):
+        day_path,_ = self.segment(path)
+        try:
+            st = os.stat(osp.join(day_path, 'index.json'))
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Checks if hour segment exists, if so returns true, else false
+    #
+    # @ Param path - path of the hour file
+    #
+    def exists(self, path):
+        day_path,key = self.segment(path)
+        return key in self.load_index(day_path)['segments']
+
+    # Remove an hour segment, the day lock has to be held
+    #
+    # @ Param path - path of the hour file
+    #
+    def remove_file(self, path):
+        day_path,key = self.segment(path)
+        index = self.load_index(day_path)
+        if key in index['segments']:
+            del index['segments'][key]
+            index.get('checksums', {}).pop(key, None)
+            if key in index.get('unsorted', []):
+                index['unsorted'].remove(key)
+            if len(index['segments']):
+                self.save_index(day_path, index)
+                self.compact(day_path, index)
+            else:
+                # no hours left in the day
+                os.remove(osp.join(day_path, 'index.json'))
+                for column in ['time','stid'] + index['columns']:
+                    if osp.exists(self.column_path(day_path, index, column)):
+                        os.remove(self.column_path(day_path, index, column))
+                self.purge(day_path, index, grace=0)
+                self.forget(day_path, index['generation'] + 1)
+
+    # Append observations to an hour, in place if the hour is the last segment of the day. The day lock has to be held.
+    #
+    # @ Param data - dataframe with new observations of the hour
+    # @ Param path - path of the hour file
+    # @ Param order - array of STIDs with the order of the station groups, None sorts by STID
+    #
+    def append_file(self, data, path, order=None):
+        day_path,key = self.segment(path)
+        index = self.load_index(day_path)
+        segment = index['segments'].get(key)
+        new_columns = [c for c in data.columns if c not in ('STID','datetime') and c not in index['columns']]
+        if segment is None or sum(segment) != index['rows'] or len(new_columns):
+            return super().append_file(data, path, order)
+        arrays = self.read_arrays(path)
+        data = new_observations(self.station_table(day_path)[arrays['stid']], arrays['time'], data)
+        if not len(data):
+            return 0
+        data = sort_observations(data, order)
+        arrays = {'time': data['datetime'].values.astype('datetime64[ns]').view(np.int64),
+                  'stid': self.encode(day_path, data['STID'].astype(str).values)}
+        for column in index['columns']:
+            arrays[column] = pd.to_numeric(data[column], errors='coerce').values if column in data else np.full(len(data), np.nan)
+        self.append(day_path, index, arrays)
+        index['segments'][key] = [segment[0], segment[1] + len(data)]
+        index['rows'] += len(data)
+        # the rows appended are after the station groups of the segment
+        if key not in index.setdefault('unsorted', []):
+            index['unsorted'].append(key)
+        index.setdefault('checksums', {})[key] = self.segment_checksum(self.segment_arrays(day_path, index, key), index['columns'])
+        self.save_index(day_path, index)
+        return len(data)
+
+    # Return paths of all the hour files of a database
+    #
+    # @ Param folder_path - path of the database
+    #
+    def list_hours(self, folder_path):
+        paths = []
+        for index_path in glob.glob(osp.join(folder_path,'[0-9]'*4,'[0-9]'*3,'index.json')):
+            day_path = osp.dirname(index_path)
+            prefix = osp.basename(osp.dirname(day_path)) + osp.basename(day_path)
+            for key in self.load_index(day_path)['segments']:
+                paths.append(osp.join(day_path, '{}{}.{}{}'.format(prefix, key[:2], self.ext, key[2:])))
+        return paths
+
+# Create dataframe of observations from column arrays without copying the value columns
+#
+# @ Param arrays - dictionary with time (int64 epoch nanoseconds), stid (int32 codes) and variable arrays
+# @ Param table - index of STIDs by station code, or categorical dtype with them as categories
+#
+def arrays_2_df(arrays, table):
+    dtype = table if isinstance(table, pd.CategoricalDtype) else pd.CategoricalDtype(table)
+    columns = {'STID': pd.Categorical.from_codes(arrays['stid'], dtype=dtype),
+               'datetime': pd.arrays.DatetimeArray(np.asarray(arrays['time']).view('datetime64[ns]'), dtype=pd.DatetimeTZDtype(tz='UTC'))}
+    for column,values in arrays.items():
+        if column not in ('time','stid'):
+            columns[column] = values
+    return pd.DataFrame(columns, copy=False)
+
+# Concatenate dictionaries of column arrays, filling with NaN the columns missing in some of them
+#
+# @ Param parts - list of dictionaries with time, stid and variable arrays
+#
+def concat_arrays(parts):
+    columns = list(dict.fromkeys(['stid','time'] + [column for part in parts for column in part]))
+    counts = [len(part['time']) for part in parts if 'time' in part]
+    result = {}
+    for column in columns:
+        dtypes = [part[column].dtype for part in parts if column in part]
+        values = np.empty(sum(counts), dtype=dtypes[0] if len(dtypes) else {'stid': np.int32, 'time': np.int64}[column])
+        n = 0
+        for part,count in zip([part for part in parts if 'time' in part], counts):
+            values[n:n+count] = part[column] if column in part else np.nan
+            n += count
+        result[column] = values
+    return result
+
+# Read hour files applying the station and time filters and return the observations as column arrays (time as int64
+# epoch nanoseconds, stid as int32 station IDs and float32 variables). Run by the processes of the parallel scans, so
+# only the arrays are sent back.
+#
+# @ Param name - storage engine name
+# @ Param folder_path - path of the database
+# @ Param hours - list of paths of the hour files and time intervals to trim them to (None keeps the whole hour)
+# @ Param stids - list of station IDs to keep, None keeps all of them
+# @ Param columns - list of columns to read, None reads all of them
+# @ Param count - number of station IDs of the scan, the first lines of the station codes
+#
+def scan_hours(name, folder_path, hours, stids, columns, count):
+    storage = get_storage(name)
+    # the station codes are only appended to, so the first lines are the station IDs known by the parent
+    with open(osp.join(folder_path, 'stations.codes'), 'r') as f:
+        categories = pd.Index(f.read().split('\n')[:count], dtype=object)
+    parts = []
+    for path,bounds in hours:
+        data = storage.read(path, columns=columns, stids=stids)
+        if bounds is not None:
+            data = trim_observations(data, bounds)
+        if not len(data):
+            continue
+        part = {'stid': station_codes(data['STID'], categories),
+                'time': data['datetime'].values.astype('datetime64[ns]').view(np.int64)}
+        for column in data.columns:
+            if column not in ('STID','datetime'):
+                part[column] = pd.to_numeric(data[column], errors='coerce').values.astype(np.float32, copy=False)
+        parts.append(part)
+    return concat_arrays(parts)
+
+# Available storage engines
+#
+storage_engines = {'pickle': pickleStorage, 'parquet': parquetStorage, 'mmap': mmapStorage}
+
+# Return a storage engine from its name
+#
+# @ Param name - name of the storage engine
+#
+def get_storage(name):
+    if name not in storage_engines:
+        raise storageError('get_storage - unknown storage engine {}, available engines are {}'.format(name, list(storage_engines.keys())))
+    return storage_engines[name]()
+
+# Read the storage engine name used by a database folder, None if not specified
+#
+# @ Param folder_path - path of the database
+#
+def read_storage_name(folder_path):
+    storage_path = osp.join(folder_path,'.storage')
+    if osp.exists(storage_path):
+        with open(storage_path,'r') as f:
+            return f.read().strip()
+    return None
+
+# Write the storage engine name used by a database folder
+#
+# @ Param folder_path - path of the database
+# @ Param name - name of the storage engine
+#
+def write_storage_name(folder_path, name):
+    with atomic_write(osp.join(folder_path,'.storage')) as tmp:
+        with open(tmp,'w') as f:
+            f.write(name+'\n')
+
+# Migrate all the hour files of a database folder from one storage engine to another in place
+#
+# @ Param folder_path - path of the database
+# @ Param target - name of the target storage engine
+#
+def migrate_tree(folder_path, target):
+    source = get_storage(read_storage_name(folder_path) or 'pickle')
+    target = get_storage(target)
+    if source.name != target.name:
+        paths = source.list_hours(folder_path)
+        logging.info('migrate_tree - migrating {} hour files from {} to {}'.format(len(paths), source.name, target.name))
+        for path in sorted(paths):
+            base,suffix = osp.splitext(path)
+            new_path = base + suffix.replace(source.ext, target.ext)
+            target.write(source.read(path), new_path)
+            source.remove(path)
+    write_storage_name(folder_path, target.name)
+
+# Runs if this is the file being used: python storage.py folder_path engine
+#
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) != 3:
+        print('usage: python storage.py folder_path {}'.format('|'.join(storage_engines.keys())))
+        sys.exit(1)
+    migrate_tree(sys.argv[1], sys.argv[2])
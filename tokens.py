@@ -0,0 +1,266 @@
+# MesoDB Token Scheduler
+
+# Libraries
+#
+import datetime
+import json
+import logging
+import os
+import os.path as osp
+import threading
+import time
+from contextlib import contextmanager
+try:
+    from .locks import *
+except:
+    from locks import *
+
+# HTTP status codes of tokens not valid or out of quota
+QUOTA_STATUS = (401, 402, 403)
+# MesoWest RESPONSE_CODE of authentication failures
+AUTH_CODE = 200
+# Words of the MesoWest response messages of tokens out of their monthly quota
+QUOTA_MESSAGES = ('quota', 'usage limit', 'payment', 'subscription')
+# Local errors raised while requesting or reading a response, not failures of the token
+REQUEST_ERRORS = (ValueError, TypeError, KeyError, IndexError, AttributeError, RuntimeError)
+
+# Token Scheduler Error
+#
+class tokenError(Exception):
+    pass
+
+# Return start of the next month at UTC, when the MesoWest quotas are reset
+#
+# @ Param utc_datetime - UTC datetime object
+#
+def next_reset(utc_datetime):
+    if utc_datetime.month == 12:
+        return datetime.datetime(utc_datetime.year+1, 1, 1, tzinfo=datetime.timezone.utc)
+    return datetime.datetime(utc_datetime.year, utc_datetime.month+1, 1, tzinfo=datetime.timezone.utc)
+
+# Return how a failed request affects its token: quota (token not valid or out of quota until the next month),
+# cooldown (rate limited or transient error) or None (error of the request, the token is not penalised). Transport
+# errors are classified by their HTTP status and MesoWest RESPONSE_CODE, other clients only by the exception type.
+#
+# @ Param error - exception raised by the request
+#
+def token_failure(error):
+    status,code = getattr(error, 'status', None),getattr(error, 'code', None)
+    if code is not None:
+        message = str(error).lower()
+        if code == AUTH_CODE or any([word in message for word in QUOTA_MESSAGES]):
+            return 'quota'
+        # rule violations and other errors of the request
+        return None
+    if status is not None:
+        if status in QUOTA_STATUS:
+            return 'quota'
+        if status == 429 or status >= 500:
+            return 'cooldown'
+        return None
+    if isinstance(error, REQUEST_ERRORS):
+        return None
+    # network errors or errors of other clients
+    return 'cooldown'
+
+# Scheduler of the MesoWest tokens tracking their usage and failures, persisted in the .tokens_state file
+#
+class tokenScheduler(object):
+
+    # Token scheduler constructor
+    #
+    # @ Param folder_path - path of the database
+    # @ Param tokens - list of MesoWest tokens
+    # @ Param factory - function creating a MesoWest client from a token (MesoPy.Meso or a fake of its interface)
+    # @ Param cooldown - seconds a token is skipped after its first failure, doubled on each consecutive failure
+    #
+    def __init__(self, folder_path, tokens, factory, cooldown=60.):
+        self.path = osp.join(folder_path, '.tokens_state')
+        self.tokens = tokens
+        self.factory = factory
+        self.cooldown = cooldown
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.active = {}
+        self.load()
+
+    # Load token states from disk
+    #
+    def load(self):
+        self.stamp = self.file_stamp()
+        self.states = self.read()
+        self.saved = json.loads(json.dumps(self.states))
+
+    # Return stamp of the token states file, None if it does not exist
+    #
+    def file_stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Load the token states saved by other processes if the file changed, the lock has to be held. The states in
+    # memory are saved on every release, so there are no changes to merge.
+    #
+    def refresh(self):
+        if self.file_stamp() != self.stamp:
+            self.load()
+
+    # Return token states saved on disk, empty if there are none
+    #
+    def read(self):
+        if osp.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    return json.load(f)
+            except Exception as e:
+                logging.warning('tokenScheduler.read - could not load {}: {}'.format(self.path, e))
+        return {}
+
+    # Return state of a token merging the changes of this process since the last save into the state saved by
+    # other processes: the counters are added, the longest skip is kept and the last failure of this process wins
+    #
+    # @ Param disk - state saved on disk
+    # @ Param state - state in memory
+    # @ Param saved - state in memory at the last save
+    #
+    def merge(self, disk, state, saved):
+        if state == saved:
+            return disk
+        merged = dict(disk)
+        for counter in ('requests','failures'):
+            merged[counter] = disk.get(counter, 0) + state[counter] - saved.get(counter, 0)
+        merged['consecutive_failures'] = state['consecutive_failures']
+        merged['skip_until'] = max(disk.get('skip_until', 0.), state['skip_until'])
+        if state['last_error'] != saved.get('last_error'):
+            merged['last_error'] = state['last_error']
+        return merged
+
+    # Save token states to disk merged with the states saved by other processes, the lock has to be held
+    #
+    # @ Param reset - tokens whose failures are forgotten also in the states saved by other processes
+    #
+    def save(self, reset=()):
+        with fileLock(self.path + '.lock'):
+            states = self.read()
+            for token,state in self.states.items():
+                states[token] = self.merge(states[token], state, self.saved.get(token, {})) if token in states else state
+            for token in reset:
+                states[token] = dict(states[token], consecutive_failures=0, skip_until=0.)
+            self.states = states
+            with atomic_write(self.path) as tmp:
+                with open(tmp, 'w') as f:
+                    json.dump(self.states, f, sort_keys=True, indent=1)
+            self.stamp = self.file_stamp()
+        self.saved = json.loads(json.dumps(self.states))
+
+    # Return state of a token, the lock has to be held
+    #
+    # @ Param token - MesoWest token
+    #
+    def state(self, token):
+        return self.states.setdefault(token, {'requests': 0, 'failures': 0, 'consecutive_failures': 0,
+                                              'skip_until': 0., 'last_error': None})
+
+    # Return True if a token can be used now, the lock has to be held
+    #
+    # @ Param token - MesoWest token
+    # @ Param now - current epoch seconds
+    #
+    def healthy(self, token, now):
+        return self.state(token)['skip_until'] <= now
+
+    # Return the MesoWest client of a token for the current thread
+    #
+    # @ Param token - MesoWest token
+    #
+    def client(self, token):
+        clients = getattr(self.local, 'clients', None)
+        if clients is None:
+            clients = self.local.clients = {}
+        if token not in clients:
+            clients[token] = self.factory(token=token)
+        return clients[token]
+
+    # Reserve the healthy token with less requests in flight and usage, waiting if all of them are busy
+    #
+    # @ Param exclude - tokens not to be used
+    # @ Param limit - maximum number of concurrent requests per token
+    #
+    def acquire(self, exclude=(), limit=2):
+        with self.cond:
+            while True:
+                self.refresh()
+                now = time.time()
+                candidates = [t for t in self.tokens if t not in exclude and self.healthy(t, now)]
+                if not len(candidates):
+                    raise tokenError('tokenScheduler.acquire - no healthy tokens available')
+                free = [t for t in candidates if self.active.get(t, 0) < limit]
+                if len(free):
+                    token = min(free, key=lambda t: (self.active.get(t, 0), self.state(t)['requests']))
+                    self.active[token] = self.active.get(token, 0) + 1
+                    return token
+                self.cond.wait()
+
+    # Release a reserved token recording the result of its request
+    #
+    # @ Param token - MesoWest token
+    # @ Param error - exception raised by the request, None if it succeeded
+    #
+    def release(self, token, error=None):
+        with self.cond:
+            self.active[token] -= 1
+            state = self.state(token)
+            state['requests'] += 1
+            if error is None:
+                state['consecutive_failures'] = 0
+            else:
+                state['last_error'] = str(error)[:200]
+            failure = token_failure(error) if error is not None else None
+            if failure is not None:
+                state['failures'] += 1
+                state['consecutive_failures'] += 1
+                now = datetime.datetime.now(datetime.timezone.utc)
+                if failure == 'quota':
+                    # not valid or out of quota until the next month
+                    state['skip_until'] = next_reset(now).timestamp()
+                else:
+                    state['skip_until'] = now.timestamp() + self.cooldown*2**(state['consecutive_failures']-1)
+                logging.warning('tokenScheduler.release - token {} skipped until {}'.format(
+                                self.tokens.index(token)+1 if token in self.tokens else '?',
+                                datetime.datetime.fromtimestamp(state['skip_until'], datetime.timezone.utc)))
+            self.save()
+            self.cond.notify_all()
+
+    # Context manager reserving a token and returning it with its client for the current thread
+    #
+    # @ Param exclude - tokens not to be used
+    # @ Param limit - maximum number of concurrent requests per token
+    #
+    @contextmanager
+    def use(self, exclude=(), limit=2):
+        token = self.acquire(exclude, limit)
+        try:
+            yield token,self.client(token)
+        except Exception as e:
+            self.release(token, e)
+            raise
+        self.release(token)
+
+    # Return usage and health of the tokens
+    #
+    def stats(self):
+        with self.cond:
+            now = time.time()
+            return [dict(self.state(t), token=k+1, healthy=self.healthy(t, now), active=self.active.get(t, 0))
+                    for k,t in enumerate(self.tokens)]
+
+    # Forget the failures of all the tokens so they are used again
+    #
+    def reset(self):
+        with self.cond:
+            for token in self.tokens:
+                self.state(token)
+            self.save(reset=self.tokens)
+            self.cond.notify_all()
@@ -0,0 +1,271 @@
+# MesoDB Fetch Transports
+
+# Libraries
+#
+import gzip
+import hashlib
+import http.client
+import json
+import logging
+import os
+import os.path as osp
+import random
+import threading
+import time
+import urllib.parse
+try:
+    from .locks import *
+    from .metrics import *
+except:
+    from locks import *
+    from metrics import *
+
+# MesoWest API root
+SYNOPTIC_URL = 'https://api.synopticdata.com/v2/'
+# HTTP status codes worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Transport Error
+#
+class transportError(Exception):
+
+    # Transport error constructor
+    #
+    # @ Param message - description of the error
+    # @ Param status - HTTP status of the last response, None if there was no response
+    # @ Param code - MesoWest RESPONSE_CODE of the response, None if the response was not an answer of the API
+    # @ Param cause - exception of the last attempt, None if there was a response
+    #
+    def __init__(self, message, status=None, code=None, cause=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.cause = cause
+
+# Pool of keep-alive HTTP connections to a host shared by all the threads
+#
+class connectionPool(object):
+
+    # Connection pool constructor
+    #
+    # @ Param url - root URL of the host
+    # @ Param size - maximum number of idle connections kept open
+    # @ Param timeout - socket timeout in seconds
+    #
+    def __init__(self, url, size=8, timeout=60.):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    # Return an idle connection or a new one
+    #
+    def get(self):
+        with self.lock:
+            if len(self.idle):
+                return self.idle.pop()
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # Return a connection to the pool after its response was read
+    #
+    # @ Param conn - HTTP connection
+    #
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    # Close all the idle connections
+    #
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+# Connection pools by root URL
+pools = {}
+pools_lock = threading.Lock()
+
+# Return the shared connection pool of a root URL
+#
+# @ Param url - root URL of the host
+# @ Param timeout - socket timeout in seconds
+#
+def get_pool(url, timeout=60.):
+    with pools_lock:
+        if url not in pools:
+            pools[url] = connectionPool(url, timeout=timeout)
+        return pools[url]
+
+# MesoWest client over pooled keep-alive connections with gzip responses and jittered exponential backoff,
+# with the timeseries interface of MesoPy.Meso
+#
+class httpTransport(object):
+
+    # HTTP transport constructor
+    #
+    # @ Param token - MesoWest token
+    # @ Param url - MesoWest API root URL
+    # @ Param timeout - socket timeout in seconds
+    # @ Param retries - number of retries of a request with a retryable error
+    # @ Param backoff - base seconds of the exponential backoff
+    # @ Param max_backoff - maximum seconds waited between retries
+    #
+    def __init__(self, token, url=SYNOPTIC_URL, timeout=60., retries=4, backoff=1., max_backoff=30.):
+        self.token = token
+        self.url = url
+        self.pool = get_pool(url, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    # Return path and query of a request
+    #
+    # @ Param service - MesoWest service (for instance, stations/timeseries)
+    # @ Param params - parameters of the request
+    #
+    def target(self, service, params):
+        params = {k: ','.join(map(str, v)) if isinstance(v, (list, tuple)) else v for k,v in params.items() if v is not None}
+        params['token'] = self.token
+        path = urllib.parse.urlsplit(self.url).path
+        return path + service + '?' + urllib.parse.urlencode(params)
+
+    # Send a request once, returns the HTTP status, headers and decompressed body
+    #
+    # @ Param target - path and query of the request
+    #
+    def send(self, target):
+        conn = self.pool.get()
+        try:
+            conn.request('GET', target, headers={'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'})
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self.pool.put(conn)
+        metrics.inc('http.requests')
+        metrics.inc('http.bytes_received', len(body))
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return response.status,response.headers,body
+
+    # Return seconds to wait before a retry, full jitter over an exponential backoff
+    #
+    # @ Param attempt - number of the failed attempt starting at 0
+    # @ Param headers - headers of the failed response, None if there was no response
+    #
+    def wait(self, attempt, headers=None):
+        retry_after = headers.get('Retry-After') if headers is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff*2**attempt))
+
+    # Request a MesoWest service retrying transient errors
+    #
+    # @ Param service - MesoWest service (for instance, stations/timeseries)
+    # @ Param params - parameters of the request
+    #
+    def request(self, service, **params):
+        target = self.target(service, params)
+        for attempt in range(self.retries+1):
+            headers = None
+            try:
+                status,headers,body = self.send(target)
+                if status == 200:
+                    break
+                error,cause = 'HTTP {}: {}'.format(status, body[:200].decode('utf-8', 'replace')),None
+                if status not in RETRY_STATUS:
+                    raise transportError('httpTransport.request - {}'.format(error), status=status)
+            except (OSError, http.client.HTTPException) as e:
+                status,error,cause = None,repr(e),e
+            if attempt == self.retries:
+                raise transportError('httpTransport.request - {} failed after {} attempts: {}'.format(service, attempt+1, error),
+                                     status=status, cause=cause)
+            delay = self.wait(attempt, headers)
+            logging.warning('httpTransport.request - {}, retrying in {:.1f} seconds'.format(error, delay))
+            metrics.inc('http.retries')
+            time.sleep(delay)
+        data = json.loads(body)
+        summary = data.get('SUMMARY', {})
+        code = summary.get('RESPONSE_CODE', 1)
+        if code == 2:
+            # no stations with data, not an error
+            data['STATION'] = []
+        elif code != 1:
+            raise transportError('httpTransport.request - {}'.format(summary.get('RESPONSE_MESSAGE', code)), status=200, code=code)
+        return data
+
+    # Request timeseries of observations like MesoPy.Meso.timeseries
+    #
+    # @ Param params - parameters of the request
+    #
+    def timeseries(self, **params):
+        return self.request('stations/timeseries', **params)
+
+# Transport replaying MesoWest responses recorded on disk, recording them first from another transport if given
+#
+class recordedTransport(object):
+
+    # Recorded transport constructor
+    #
+    # @ Param token - MesoWest token, only used when recording
+    # @ Param folder - folder of the recorded responses
+    # @ Param record - function creating the transport used to record missing responses, None only replays
+    # @ Param delay - seconds added to each replayed response to simulate the network latency
+    #
+    def __init__(self, token=None, folder='responses', record=None, delay=0.):
+        self.folder = folder
+        self.client = record(token=token) if record is not None else None
+        self.delay = delay
+
+    # Return path of the recorded response of a request
+    #
+    # @ Param service - MesoWest service
+    # @ Param params - parameters of the request
+    #
+    def path(self, service, params):
+        key = json.dumps([service, params], sort_keys=True, default=str)
+        return osp.join(self.folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json.gz')
+
+    # Return recorded response of a request, recording it if missing
+    #
+    # @ Param service - MesoWest service
+    # @ Param params - parameters of the request
+    #
+    def request(self, service, **params):
+        path = self.path(service, params)
+        if osp.exists(path):
+            with gzip.open(path, 'rb') as f:
+                data = json.load(f)
+            if self.delay:
+                time.sleep(self.delay)
+            return data
+        if self.client is None:
+            raise transportError('recordedTransport.request - no recorded response for {} {}'.format(service, params))
+        data = getattr(self.client, service.split('/')[-1])(**params)
+        if not osp.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        with atomic_write(path) as tmp:
+            with gzip.open(tmp, 'wt') as f:
+                json.dump(data, f)
+        return data
+
+    # Request timeseries of observations like MesoPy.Meso.timeseries
+    #
+    # @ Param params - parameters of the request
+    #
+    def timeseries(self, **params):
+        return self.request('stations/timeseries', **params)
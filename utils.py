@@ -1,8 +1,17 @@
 import datetime
+import functools
+import io
+import json
 import logging
 import os.path as osp
 import os
+import re
+import numpy as np
 import pandas as pd
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Check coordinates and return properly coordinates
 #
@@ -29,37 +38,199 @@ def check_coords(latitude1, latitude2, longitude1, longitude2):
 # Returns the time in Meso format
 # 
 # @ Param utc_datetime - datetime in UTC
+# @ Param exact - keep the minutes, otherwise the time is truncated to the hour
 #
-def meso_time(utc_datetime):
+def meso_time(utc_datetime, exact=False):
     year = utc_datetime.year
     month = utc_datetime.month
     day = utc_datetime.day
     hour = utc_datetime.hour
-    return "{:04d}{:02d}{:02d}{:02d}{:02d}".format(year,month,day,hour,0)
+    minute = utc_datetime.minute if exact else 0
+    return "{:04d}{:02d}{:02d}{:02d}{:02d}".format(year,month,day,hour,minute)
 
-# Tranform dictionary data from MesoWest request to pandas dataframe
+# Split observations by hour with a single vectorized pass
+#
+# @ Param data - dataframe with observations
+#
+def hour_groups(data):
+    if not len(data):
+        return {}
+    hours = data['datetime'].dt.floor('h')
+    return {hour: group for hour,group in data.groupby(hours, sort=False)}
+
+# Column names of MesoWest variables that are not saved with their own name
+meso_columns = {'fuel_moisture': 'fm10'}
+
+# Return the dataframe column of a MesoWest observation key, None if it is not a variable
+#
+# @ Param key - observation key from MesoWest (for instance, fuel_moisture_set_1)
+#
+@functools.lru_cache(maxsize=None)
+def meso_column(key):
+    match = re.match(r'^(.+)_set_(\d+)d?$', key)
+    if match is None:
+        return None
+    return meso_columns.get(match.group(1), match.group(1))
+
+# Parse MesoWest timestamps to UTC datetimes, fast path for the fixed format YYYY-mm-ddTHH:MM:SSZ
+#
+# @ Param values - list or array of timestamp strings
+#
+def parse_meso_times(values):
+    try:
+        return pd.to_datetime(values, format='%Y-%m-%dT%H:%M:%SZ', utc=True)
+    except (TypeError, ValueError):
+        return pd.to_datetime(values, utc=True)
+
+# Iterate stations of a MesoWest response. The response can be a dictionary or a file-like object or string
+# with the JSON response, that is parsed incrementally if ijson is installed
+#
+# @ Param mesowestData - MesoWest response
+#
+def iter_meso_stations(mesowestData):
+    if isinstance(mesowestData, dict):
+        for stData in mesowestData.get('STATION', []):
+            yield stData
+    else:
+        if isinstance(mesowestData, (str, bytes)):
+            mesowestData = io.BytesIO(mesowestData.encode() if isinstance(mesowestData, str) else mesowestData)
+        if ijson is None:
+            logging.debug('iter_meso_stations - ijson not installed, parsing complete response')
+            for stData in json.load(mesowestData).get('STATION', []):
+                yield stData
+        else:
+            for stData in ijson.items(mesowestData, 'STATION.item', use_float=True):
+                yield stData
+
+# Tranform data from MesoWest request to pandas dataframes of observations and sites
+# The observations are in the compact schema (STID categorical, datetime at UTC and float32 variables)
 # 
-# @ Param utc_datetime - datetime in UTC
+# @ Param mesowestData - MesoWest response as a dictionary or as a file-like object or string with the JSON
+# @ Param variables - list of MesoWest variables to keep, None keeps all the variables in the response
 #
-def meso_data_2_df(mesowestData):
+def meso_data_2_df(mesowestData, variables=None):
     if mesowestData is None:
         return pd.DataFrame([]),pd.DataFrame([])
+    if variables is not None:
+        variables = [meso_columns.get(var, var) for var in variables]
     site_keys = ['STID','LONGITUDE','LATITUDE','ELEVATION','STATE']
     site_dic = {key: [] for key in site_keys}
-    data_keys = ['STID','datetime','fm10']
-    data_dic = {key: [] for key in data_keys}
-    for stData in mesowestData['STATION']:
-        for site_key in site_keys:
-            site_dic[site_key].append(stData[site_key]) 
-        data_dic['STID'] += [stData['STID']]*len(stData['OBSERVATIONS']['date_time'])
-        data_dic['datetime'] += stData['OBSERVATIONS']['date_time']
-        data_dic['fm10'] += stData['OBSERVATIONS']['fuel_moisture_set_1']
-    
-    data = pd.DataFrame.from_dict(data_dic)
-    data['datetime'] = pd.to_datetime(data['datetime'])
+    # preallocate arrays from the observation counts when the whole response is available
+    if isinstance(mesowestData, dict):
+        size = sum([len(stData['OBSERVATIONS']['date_time']) for stData in mesowestData.get('STATION', [])])
+    else:
+        size = 1024
+    codes = np.empty(size, dtype=np.int32)
+    times = np.empty(size, dtype=object)
+    values = {}
+    stids = {}
+    n = 0
+    for stData in iter_meso_stations(mesowestData):
+        # intern station IDs to categorical codes
+        code = stids.get(stData['STID'])
+        if code is None:
+            code = stids[stData['STID']] = len(stids)
+            for site_key in site_keys:
+                site_dic[site_key].append(stData.get(site_key)) 
+        observations = stData['OBSERVATIONS']
+        m = len(observations['date_time'])
+        if n + m > len(times):
+            size = max(2*len(times), n + m)
+            codes = np.resize(codes, size)
+            times = np.resize(times, size)
+            for column in values:
+                values[column] = np.resize(values[column], size)
+        codes[n:n+m] = code
+        times[n:n+m] = observations['date_time']
+        # keep the first sensor set of each variable
+        keys = {}
+        for key in sorted(observations.keys(), reverse=True):
+            column = meso_column(key)
+            if column is not None and (variables is None or column in variables):
+                keys[column] = key
+        for column in keys:
+            if column not in values:
+                values[column] = np.full(len(times), np.nan, dtype=np.float32)
+        for column in values:
+            if column in keys:
+                try:
+                    values[column][n:n+m] = observations[keys[column]]
+                except (TypeError, ValueError):
+                    values[column][n:n+m] = pd.to_numeric(pd.Series(observations[keys[column]], dtype=object), errors='coerce').values
+            else:
+                values[column][n:n+m] = np.nan
+        n += m
+
+    data = pd.DataFrame({'STID': pd.Categorical.from_codes(codes[:n], categories=list(stids.keys())),
+                         'datetime': parse_meso_times(times[:n])})
+    for column in sorted(values, key=lambda c: (c != 'fm10', c)):
+        data[column] = values[column][:n]
     sites = pd.DataFrame.from_dict(site_dic).set_index('STID')
     return data,sites
 
+# Return codes of STIDs as positions in an index of STIDs, -1 for the ones not in it
+#
+# @ Param stids - series of STIDs, as strings or categorical
+# @ Param categories - index of STIDs
+#
+def station_codes(stids, categories):
+    if isinstance(stids.dtype, pd.CategoricalDtype):
+        names = stids.cat.categories
+        # recode the categories, codes of missing values (-1) map to the last position
+        recode = np.append(categories.get_indexer(names if names.dtype == object else names.astype(str)), -1)
+        return recode.astype(np.int32)[stids.cat.codes.values]
+    return categories.get_indexer(stids.values if stids.dtype == object else stids.astype(str).values).astype(np.int32)
+
+# Return STIDs as a categorical series. With categories, the codes are the positions of the STIDs in them, so the
+# observations of different hours share the same codes (STIDs not in the categories are missing values)
+#
+# @ Param stids - series of STIDs, as strings, categorical or codes in the categories
+# @ Param categories - categorical dtype with STIDs as categories, None uses the STIDs present
+#
+def station_categorical(stids, categories=None):
+    if categories is None:
+        if isinstance(stids.dtype, pd.CategoricalDtype):
+            return stids.cat.remove_unused_categories()
+        return stids.astype(str).astype('category')
+    if stids.dtype is categories:
+        return stids
+    if pd.api.types.is_integer_dtype(stids.dtype):
+        codes = stids.values
+    else:
+        codes = station_codes(stids, categories.categories)
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=categories), index=stids.index, name=stids.name)
+
+# Cast observations to the compact schema: STID categorical, datetime as datetime64 at UTC (int64 epoch
+# nanoseconds) and variables as float32 with NaN for the missing values. Legacy frames with object columns
+# are converted too.
+#
+# @ Param data - dataframe with observations
+# @ Param categories - categorical dtype with STIDs as categories, None uses the STIDs present
+#
+def compact_observations(data, categories=None):
+    data = data.copy(deep=False)
+    if 'STID' in data:
+        data['STID'] = station_categorical(data['STID'], categories)
+    if 'datetime' in data and not isinstance(data['datetime'].dtype, pd.DatetimeTZDtype):
+        data['datetime'] = pd.to_datetime(data['datetime'], utc=True)
+    for column in data.columns:
+        if column not in ('STID','datetime') and data[column].dtype != np.float32:
+            data[column] = pd.to_numeric(data[column], errors='coerce').astype(np.float32)
+    return data
+
+# Cast observations to the schema of the databases before the compact one: STID as strings and variables as float64
+#
+# @ Param data - dataframe with observations
+#
+def legacy_observations(data):
+    data = data.copy(deep=False)
+    if 'STID' in data:
+        data['STID'] = data['STID'].astype(str).astype(object)
+    for column in data.columns:
+        if column not in ('STID','datetime'):
+            data[column] = pd.to_numeric(data[column], errors='coerce').astype(np.float64)
+    return data
+
 # Ensure all directories in path if a file exist, for convenience return path itself.
 #
 # @ Param path - the path whose directories should exist
@@ -67,7 +238,7 @@ def meso_data_2_df(mesowestData):
 def ensure_dir(path):
     path_dir = osp.dirname(path)
     if not osp.exists(path_dir):
-        os.makedirs(path_dir)
+        os.makedirs(path_dir, exist_ok=True)
     return path
 
 # Set UTC datetime from integers